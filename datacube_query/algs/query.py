@@ -1,41 +1,61 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from datetime import datetime
+from functools import partial
 import json
 from pathlib import Path
-
-from datacube.utils import geometry
-from sqlalchemy.exc import SQLAlchemyError
+from threading import Lock
 
 import processing
 
 from processing.core.parameters import (
+    QgsProcessingParameterBoolean as ParameterBoolean,
     QgsProcessingParameterCrs as ParameterCrs,
     QgsProcessingParameterEnum as ParameterEnum,
     QgsProcessingParameterExtent as ParameterExtent,
     QgsProcessingParameterNumber as ParameterNumber,
+    QgsProcessingParameterString as ParameterString,
     QgsProcessingParameterFolderDestination as ParameterFolderDestination)
 
 from processing.core.outputs import (
     QgsProcessingOutputMultipleLayers as OutputMultipleLayers)
 
 from qgis.core import (
-    QgsLogger,
     QgsProcessingContext,
-    QgsProcessingException)
+    QgsProcessingException,
+    QgsProcessingUtils)
 
 from .__base__ import BaseAlgorithm
-from ..defaults import GROUP_BY_FUSE_FUNC
-from ..exceptions import (NoDataError, TooManyDatasetsError)
+from ..catalogue import catalogue_items, get_catalogue, get_catalogue_loader
+from ..defaults import (
+    CATALOGUE_CACHE_TTL, COMPOSITES, GDAL_THREADS, GROUP_BY_FUSE_FUNC, MEMORY_BUDGET, OUTPUT_FORMATS, OUTPUT_LAYOUTS,
+    OUTPUT_WORKERS, PIXEL_CACHE_SIZE, PREVIEW_SCALE, PRODUCT_WORKERS)
+from ..exceptions import (NoDataError, TooManyDatasetsError, TooMuchDataError)
+from ..manifest import (
+    journal_file, manifest_entry, manifest_file, read_journal, read_manifest,
+    run_fingerprint, up_to_date, write_journal, write_manifest)
 from ..parameters import (ParameterDateRange, ParameterProducts)
-from ..qgisutils import (get_icon)
+from ..qgisutils import (get_cache_dir, get_icon)
+from ..timing import Timings, labelled, recording, trace_file
 from ..utils import (
-    build_overviews,
+    MemoryBudget,
+    PixelCache,
+    bounded_imap,
+    build_dask_chunks,
     build_query,
-    calculate_statistics,
+    build_vrt,
+    composite,
     datetime_to_str,
-    get_products_and_measurements,
-    run_query,
-    update_tags,
+    dtype_nodata,
+    evaluate_expression,
+    expression_aliases,
+    format_bytes,
+    get_nodata,
+    group_datasets,
+    parse_expression,
+    run_tiled_query,
+    scale_query,
+    search_datasets,
+    validate_raster,
     write_geotiff
 )
 
@@ -58,21 +78,40 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
     PARAM_OUTPUT_RESOLUTION = ('Output pixel resolution '
                                '(required for products with no resolution defined)')
     PARAM_GROUP_BY = 'Group data by'
+    PARAM_REUSE_OUTPUTS = 'Reuse existing outputs that are up to date?'
+    PARAM_PREVIEW = 'Quick low resolution preview?'
+    PARAM_COMPOSITE = 'Temporal composite'
+    PARAM_PERCENTILE = 'Composite percentile (0-100)'
+    PARAM_EXPRESSION = 'Band math expression, e.g. (nir - red) / (nir + red)'
 
-    def __init__(self, products=None):
+    def __init__(self, products=None, catalogue=None):
         """
         Initialise the algorithm
 
         :param dict products: A dict of products as returned by
             :func:`datacube_query.utils.get_products_and_measurements`
+        :param datacube_query.catalogue.CatalogueLoader catalogue: Optional loader
+            the products are read from instead, as they're loaded in the background.
         """
         super().__init__()
 
         self._icon = get_icon('opendatacube.png')
-        self.products = {} if products is None else products
+        self._products = {} if products is None else products
+        self._catalogue = catalogue
         self.outputs = {}
 
+    @property
+    def products(self):
+        """
+        The current products. The loader replaces its dict rather than changing it,
+        so read this once and use that snapshot for the rest of a check or run.
+
+        :rtype: dict
+        """
+        return self._catalogue.products if self._catalogue is not None else self._products
+
     def checkParameterValues(self, parameters, context):
+        from datacube.utils import geometry  # Deferred so loading the plugin doesn't import datacube
 
         msgs = []
 
@@ -103,6 +142,25 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
             except geometry.InvalidCRSError:
                 msgs += ['Please set a valid EPSG CRS for your project/layer']
 
+        expression = self.parameterAsString(parameters, self.PARAM_EXPRESSION, context)
+        if expression:
+            try:
+                _, names = parse_expression(expression)
+            except ValueError as err:
+                msgs += [str(err)]
+            else:
+                product_descs = json.loads(self.parameterAsString(parameters, self.PARAM_PRODUCTS, context))
+                catalogue = self.products
+                for k, v in product_descs.items():
+                    if k not in catalogue:
+                        continue
+                    # Measurements can be used by name or alias
+                    aliases = expression_aliases(names, {m: catalogue[k]['measurements'][m] for m in v})
+                    missing = names - set(aliases)
+                    if missing:
+                        msgs += ['Please select the {} measurements used in the expression for {}'.format(
+                            ', '.join(sorted(missing)), k)]
+
         output_crs = self.parameterAsCrs(parameters, self.PARAM_OUTPUT_CRS, context)
         output_res = self.parameterAsDouble(parameters, self.PARAM_OUTPUT_RESOLUTION, context)
         if output_crs.isValid():
@@ -119,14 +177,12 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
         return super().checkParameterValues(parameters, context)
 
     def createInstance(self, config=None):
-        try:
-            products = self.get_products_and_measurements()
-        except SQLAlchemyError:
-            msg = 'Unable to connect to a running Data Cube instance'
-            QgsLogger().warning(msg)
-            products = {msg: {'measurements': {}}}
+        # Products are loaded in the background, instances read whichever catalogue the loader has
+        loader = get_catalogue_loader()
+        config_file, ttl = self.get_catalogue_settings()
+        loader.load(config=config_file, cache_dir=get_cache_dir(), ttl=ttl)
 
-        return type(self)(products)
+        return type(self)(catalogue=loader)
 
     def displayName(self, *args, **kwargs):
         return self.tr('Data Cube Query')
@@ -140,9 +196,18 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
         # return self.FlagCanCancel
         return super().flags() & ~self.FlagSupportsBatch
 
+    def get_catalogue_settings(self):
+        settings = self.get_settings()
+        config_file = settings['datacube_config_file'] or None
+        try:
+            ttl = int(settings['datacube_catalogue_cache_ttl'])
+        except (TypeError, ValueError):
+            ttl = CATALOGUE_CACHE_TTL
+        return config_file, ttl
+
     def get_products_and_measurements(self):
-        config_file = self.get_settings()['datacube_config_file'] or None
-        return get_products_and_measurements(config=config_file)
+        config_file, ttl = self.get_catalogue_settings()
+        return get_catalogue(config=config_file, cache_dir=get_cache_dir(), ttl=ttl)
 
     def group(self):
         """
@@ -159,13 +224,9 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
         """
 
         # Basic Params
-        items = defaultdict(list)
-        for k, v in self.products.items():
-            items[k] += v['measurements'].keys()
-
         self.addParameter(ParameterProducts(self.PARAM_PRODUCTS,
                                             self.tr(self.PARAM_PRODUCTS),
-                                            items=items))
+                                            items=catalogue_items(self.products)))
 
         self.addParameter(ParameterDateRange(self.PARAM_DATE_RANGE,
                                              self.tr(self.PARAM_DATE_RANGE),
@@ -184,6 +245,27 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
                               options=GROUP_BY_FUSE_FUNC.keys(), defaultValue=0)
         self.addParameter(param)
 
+        param = ParameterBoolean(self.PARAM_REUSE_OUTPUTS, self.tr(self.PARAM_REUSE_OUTPUTS),
+                                 optional=True, defaultValue=False)
+        self.addParameter(param)
+
+        param = ParameterBoolean(self.PARAM_PREVIEW, self.tr(self.PARAM_PREVIEW),
+                                 optional=True, defaultValue=False)
+        self.addParameter(param)
+
+        param = ParameterEnum(self.PARAM_COMPOSITE, self.tr(self.PARAM_COMPOSITE), allowMultiple=False,
+                              options=COMPOSITES.keys(), defaultValue=0)
+        self.addParameter(param)
+
+        param = ParameterNumber(self.PARAM_PERCENTILE, self.tr(self.PARAM_PERCENTILE),
+                                type=ParameterNumber.Double, optional=True, defaultValue=50,
+                                minValue=0, maxValue=100)
+        self.addParameter(param)
+
+        param = ParameterString(self.PARAM_EXPRESSION, self.tr(self.PARAM_EXPRESSION),
+                                optional=True, defaultValue='')
+        self.addParameter(param)
+
         # Output/s
         self.addParameter(ParameterFolderDestination(self.OUTPUT_FOLDER,
                                                      self.tr(self.OUTPUT_FOLDER)),
@@ -230,15 +312,44 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
         gtiff_ovr_options = json.loads(settings['datacube_gtiff_ovr_options'])
         overviews = settings['datacube_build_overviews']
         calc_stats = settings['datacube_calculate_statistics']
-        approx_ok = settings['datacube_approx_statistics']
+        output_format = OUTPUT_FORMATS.get(settings['datacube_output_format'], 'GTiff')
+        output_layout = OUTPUT_LAYOUTS.get(settings['datacube_output_layout'], 'date')
+        try:
+            output_workers = int(settings['datacube_output_workers'])
+        except (TypeError, ValueError):
+            output_workers = OUTPUT_WORKERS
+        try:
+            gdal_threads = int(settings['datacube_gdal_threads'])
+        except (TypeError, ValueError):
+            gdal_threads = GDAL_THREADS
+        try:
+            product_workers = int(settings['datacube_product_workers'])
+        except (TypeError, ValueError):
+            product_workers = PRODUCT_WORKERS
+        try:
+            memory_budget = int(settings['datacube_memory_budget']) * 2**20
+        except (TypeError, ValueError):
+            memory_budget = MEMORY_BUDGET * 2**20
+        auto_tile = settings['datacube_auto_tile']
+        pixel_cache = None
+        if settings['datacube_pixel_cache_dir']:
+            try:
+                pixel_cache_size = int(settings['datacube_pixel_cache_size']) * 2**20
+            except (TypeError, ValueError):
+                pixel_cache_size = PIXEL_CACHE_SIZE * 2**20
+            pixel_cache = PixelCache(settings['datacube_pixel_cache_dir'], pixel_cache_size)
+        timing_trace = settings['datacube_timing_trace']
 
         # Parameters
         product_descs = self.parameterAsString(parameters, self.PARAM_PRODUCTS, context)
         product_descs = json.loads(product_descs)
+        catalogue = self.products  # Snapshot, a background refresh swaps in a new dict
+        if not all(k in catalogue for k in product_descs):  # e.g. run before the background load finished
+            catalogue = self.get_products_and_measurements()
         products = defaultdict(list)
         for k, v in product_descs.items():
             for m in v:
-                products[self.products[k]['product']] += [self.products[k]['measurements'][m]]
+                products[catalogue[k]['product']] += [catalogue[k]['measurements'][m]]
 
         date_range = self.parameterAsString(parameters, self.PARAM_DATE_RANGE, context)
         date_range = json.loads(date_range)
@@ -259,19 +370,54 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
         group_by = self.parameterAsEnum(parameters, self.PARAM_GROUP_BY, context)
         group_by, fuse_func = GROUP_BY_FUSE_FUNC[list(GROUP_BY_FUSE_FUNC.keys())[group_by]]
 
+        reuse_outputs = self.parameterAsBool(parameters, self.PARAM_REUSE_OUTPUTS, context)
+        preview = self.parameterAsBool(parameters, self.PARAM_PREVIEW, context)
+
+        composite_method = self.parameterAsEnum(parameters, self.PARAM_COMPOSITE, context)
+        composite_method = COMPOSITES[list(COMPOSITES.keys())[composite_method]]
+        percentile = self.parameterAsDouble(parameters, self.PARAM_PERCENTILE, context)
+        composite_options = None if composite_method is None else (composite_method, percentile)
+
+        # Only the measurements used in a band math expression are loaded,
+        # the names in the expression are matched to each product's measurements by name or alias
+        expression = self.parameterAsString(parameters, self.PARAM_EXPRESSION, context).strip() or None
+        aliases = {}  # {product: {name in expression: measurement}}
+        if expression is not None:
+            _, names = parse_expression(expression)
+            for k, v in product_descs.items():
+                product = catalogue[k]['product']
+                aliases[product] = expression_aliases(names, {m: catalogue[k]['measurements'][m] for m in v})
+                products[product] = [m for m in products[product] if m in aliases[product].values()]
+
         output_folder = self.parameterAsString(parameters, self.OUTPUT_FOLDER, context)
+        if preview:  # Previews are temporary layers
+            output_folder = QgsProcessingUtils.generateTempFilename('datacube_preview')
         feedback.pushInfo('output_folder: {}'.format(repr(output_folder)))
 
         processing.mkdir(output_folder)
 
-        dask_chunks = {'time': 1} if date_range is not None else None
+        # Load lazily in chunks aligned to the output blocks so they can be streamed to disk
+        dask_chunks = build_dask_chunks(gtiff_options)
+
+        # Options for write_geotiff
+        write_options = dict(profile_override=gtiff_options,
+                             overview_options=gtiff_ovr_options if overviews else None,
+                             statistics=calc_stats,
+                             cog=output_format == 'COG',
+                             threads=gdal_threads,
+                             stack=output_layout == 'stack' and composite_options is None)
+        scale = 1
+        if preview:  # Coarse resolution, without the extras that slow down writing
+            write_options.update(overview_options=None, statistics=False, cog=False)
+            scale = PREVIEW_SCALE
 
         output_layers = self.execute(
             products, date_range, extent, extent_crs,
             output_crs, output_res, output_folder,
-            config_file, dask_chunks, overviews, calc_stats, approx_ok,
-            gtiff_options, gtiff_ovr_options,
-            group_by, fuse_func, max_datasets, feedback)
+            config_file, dask_chunks, write_options,
+            group_by, fuse_func, max_datasets, output_workers,
+            product_workers, memory_budget, auto_tile, pixel_cache, reuse_outputs, scale,
+            composite_options, expression, aliases, timing_trace, feedback)
 
         results = {self.OUTPUT_FOLDER: output_folder, self.OUTPUT_LAYERS: output_layers.keys()}
         self.outputs = output_layers # This is used in postProcessAlgorithm
@@ -281,73 +427,311 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
     def execute(self,
                 products, date_range, extent, extent_crs,
                 output_crs, output_res, output_folder,
-                config_file, dask_chunks, overviews, calc_stats, approx_ok,
-                gtiff_options, gtiff_ovr_options,
-                group_by, fuse_func, max_datasets, feedback):
+                config_file, dask_chunks, write_options,
+                group_by, fuse_func, max_datasets, output_workers,
+                product_workers, memory_budget, auto_tile, pixel_cache, reuse_outputs, scale,
+                composite_options, expression, aliases, timing_trace, feedback):
 
         output_layers = {}
-        progress_total = 100 / (10*len(products))
         feedback.setProgress(0)
 
-        for idx, (product, measurements) in enumerate(products.items()):
-
-            if feedback.isCanceled():
-                return output_layers
-
-            feedback.setProgressText('Processing {}'.format(product))
-
-            try:
-                query = build_query(
-                    product, measurements,
-                    date_range, extent,
-                    extent_crs, output_crs,
-                    output_res, dask_chunks=dask_chunks,
-                    group_by=group_by, fuse_func=fuse_func)
-
-                # feedback.setProgressText('Query {}'.format(repr(query)))
-                feedback.pushInfo('Query: {}'.format(repr(query)))
-
-                data = run_query(query, config_file, max_datasets=max_datasets)
-
-            except (NoDataError, TooManyDatasetsError) as err:
-                # feedback.pushInfo('{}'.format(err))
-                feedback.reportError('Error encountered processing {}: {}'.format(product, err))
-                feedback.setProgress(int((idx + 1) * 10 * progress_total))
-                continue
-
-            basename = '{}_{}'.format(product, '{}')
-            basepath = str(Path(output_folder, basename))
-
-            feedback.setProgressText('Saving outputs for {}'.format(product))
-            for i, dt in enumerate(data.time):
-                if group_by is None:
-                    ds = datetime_to_str(dt.data, '%Y-%m-%d_%H-%M-%S')
-                    tag = datetime_to_str(dt.data, '%Y:%m:%d %H:%M:%S')
-                else:
-                    ds = datetime_to_str(dt.data)
-                    tag = datetime_to_str(dt.data, '%Y:%m:%d')
+        # An unfinished run into the same folder with the same parameters was cancelled or crashed,
+        # so resume it by reusing the outputs it finished
+        journal_path = journal_file(output_folder)
+        run = run_fingerprint(products=products, date_range=date_range, extent=extent, extent_crs=extent_crs,
+                              output_crs=output_crs, output_res=output_res, write_options=write_options,
+                              group_by=group_by, fuse_func=fuse_func, scale=scale,
+                              composite_options=composite_options, expression=expression)
+        journal = read_journal(journal_path)
+        if journal.get('run') == run and not journal.get('finished'):
+            feedback.pushInfo('Resuming an interrupted run, finished outputs will be checked and reused')
+            reuse_outputs = True
+        write_journal(journal_path, run, finished=False)
+
+        progress = {}
+        progress_lock = Lock()
+
+        def set_progress(idx, fraction):
+            with progress_lock:
+                progress[idx] = fraction
+                feedback.setProgress(int(100 * sum(progress.values()) / len(products)))
+
+        budget = MemoryBudget(memory_budget)
+
+        def process_product(product_item):
+            idx, (product, measurements) = product_item
+            with labelled(product=product):
+                return self.execute_product(
+                    product, measurements, date_range, extent, extent_crs,
+                    output_crs, output_res, output_folder,
+                    config_file, dask_chunks, write_options,
+                    group_by, fuse_func, max_datasets, output_workers,
+                    budget, auto_tile, pixel_cache, reuse_outputs, scale, composite_options, expression,
+                    aliases.get(product), partial(set_progress, idx), feedback)
+
+        # Products are searched, loaded and written concurrently, their outputs are returned in order
+        timings = Timings()
+        with recording(timings):
+            results = bounded_imap(process_product, enumerate(products.items()),
+                                   max_workers=product_workers, is_canceled=feedback.isCanceled)
+            for product_layers in results:
+                output_layers.update(product_layers)
+
+        self.report_timings(timings, products, feedback)
+        if timing_trace:
+            trace_path = trace_file(output_folder)
+            timings.write_trace(trace_path)
+            feedback.pushInfo('Timing trace written to {}'.format(trace_path))
+
+        if not feedback.isCanceled():
+            write_journal(journal_path, run, finished=True)
 
-                raster_path = basepath.format(ds) + '.tif'
+        return output_layers
 
-                write_geotiff(data, raster_path, time_index=i,
-                              profile_override=gtiff_options, overwrite=True)
+    def execute_product(self,
+                        product, measurements, date_range, extent, extent_crs,
+                        output_crs, output_res, output_folder,
+                        config_file, dask_chunks, write_options,
+                        group_by, fuse_func, max_datasets, output_workers,
+                        budget, auto_tile, pixel_cache, reuse_outputs, scale, composite_options, expression,
+                        aliases, set_progress, feedback):
 
-                update_tags(raster_path, TIFFTAG_DATETIME=tag)
+        output_layers = {}
+        stack = write_options.get('stack', False)
 
-                if overviews:
-                    build_overviews(raster_path, gtiff_ovr_options)
+        feedback.setProgressText('Processing {}'.format(product))
 
-                if calc_stats:
-                    calculate_statistics(raster_path, approx_ok)
+        def time_slice_names(dt):
+            if group_by is None:
+                return datetime_to_str(dt.data, '%Y-%m-%d_%H-%M-%S'), datetime_to_str(dt.data, '%Y:%m:%d %H:%M:%S')
+            else:
+                return datetime_to_str(dt.data), datetime_to_str(dt.data, '%Y:%m:%d')
 
-                lyr_name = basename.format(ds)
-                output_layers[raster_path] = lyr_name
+        manifest_path = manifest_file(output_folder, product)
+        manifest = read_manifest(manifest_path)
+        entries = {}  # {ds: manifest entry}
+        outputs = {}  # {ds: raster_path}
 
-                feedback.setProgress(int((idx * 10 + i + 1) * progress_total))
+        try:
+            query = build_query(
+                product, measurements,
+                date_range, extent,
+                extent_crs, output_crs,
+                output_res, dask_chunks=dask_chunks,
+                group_by=group_by, fuse_func=fuse_func)
+
+            # feedback.setProgressText('Query {}'.format(repr(query)))
+            feedback.pushInfo('Query: {}'.format(repr(query)))
+
+            datasets = search_datasets(query, config_file, max_datasets)
+
+            if scale > 1:
+                query = scale_query(query, datasets, scale)
+                feedback.pushInfo('Loading {} at {} times the output pixel size'.format(product, scale))
+
+            # Each output is named by its date, or the composite method and date range,
+            # and made from the datasets grouped into it
+            grouped = group_datasets(query, datasets)
+            entry_query = query if expression is None else dict(query, expression=expression)
+            first, first_tag = time_slice_names(grouped.time[0])
+            last, last_tag = time_slice_names(grouped.time[-1])
+            if stack:
+                # Every time slice of a measurement is stacked into one output
+                stack_names = {var: '{}_{}_{}'.format(var, first, last)
+                               for var in (['expression'] if expression is not None else measurements)}
+                stack_tags = {'START_DATETIME': first_tag, 'END_DATETIME': last_tag}
+                output_sources = [(ds, list(datasets)) for ds in stack_names.values()]
+            elif composite_options is None:
+                output_sources = [(time_slice_names(dt)[0], list(sources))
+                                  for dt, sources in zip(grouped.time, grouped.values)]
+            else:
+                method, percentile = composite_options
+                composite_name = 'p{:g}'.format(percentile) if method == 'percentile' else method
+                composite_ds = '{}_{}_{}'.format(composite_name, first, last)
+                composite_tags = {'COMPOSITE': composite_name, 'START_DATETIME': first_tag, 'END_DATETIME': last_tag}
+                output_sources = [(composite_ds, list(datasets))]
+                entry_query = dict(entry_query, composite=composite_name)
+
+            # Outputs that are up to date from a previous run aren't loaded again
+            datasets = []
+            for ds, sources in output_sources:
+                entries[ds] = manifest_entry(entry_query, write_options, sources)
+                existing = up_to_date(manifest, ds, entries[ds], output_folder) if reuse_outputs else None
+                if existing is not None and not validate_raster(existing):
+                    feedback.pushInfo('Existing output {} is incomplete and will be rewritten'.format(existing))
+                    existing = None
+                if existing is None:
+                    datasets += sources
+                    manifest.pop(ds, None)
+                else:
+                    outputs[ds] = str(existing)
+            datasets = list(OrderedDict((dataset.id, dataset) for dataset in datasets).values())
+
+            # Stacks of measurements that are up to date aren't loaded again
+            if stack and expression is None:
+                query = dict(query, measurements=[m for m in measurements if stack_names[m] not in outputs])
+
+            # Outputs about to be overwritten are removed from the manifest first,
+            # so a partially written output is never trusted if the run is interrupted
+            write_manifest(manifest_path, manifest)
+
+            if outputs:
+                feedback.pushInfo('Reusing {} of {} existing outputs for {}'.format(
+                    len(outputs), len(entries), product))
+
+            # Queries too large for the memory budget are split into tiles aligned to the dask chunks
+            tiles = []
+            if datasets:
+                tiles = run_tiled_query(query, config_file, max_bytes=budget.nbytes,
+                                        concurrency=output_workers, feedback=feedback,
+                                        tile=auto_tile, tile_align=(dask_chunks['y'], dask_chunks['x']),
+                                        cache=pixel_cache, datasets=datasets, expression=expression,
+                                        composite=None if composite_options is None else composite_options[0])
+
+        except (NoDataError, TooManyDatasetsError, TooMuchDataError) as err:
+            # feedback.pushInfo('{}'.format(err))
+            feedback.reportError('Error encountered processing {}: {}'.format(product, err))
+            set_progress(1)
+            return output_layers
+
+        basename = '{}_{}'.format(product, '{}') + ('_preview' if scale > 1 else '')
+        basepath = str(Path(output_folder, basename))
+        tiled = bool(tiles) and tiles[0][0] is not None
+
+        def output_jobs(index, data):
+            # Each job is written to a raster: (tile index, data, time index, ds, tags)
+            extra_tags = {}
+            if expression is not None:  # Only the derived band is written
+                data = evaluate_expression(data, expression, aliases=aliases)
+                extra_tags['EXPRESSION'] = expression
+
+            if stack:
+                # Tiles only have the time slices with data, but every tile of a stack needs the same bands,
+                # so missing time slices are filled with nodata. Data without nodata is promoted to a dtype
+                # with room for a nodata value that isn't valid data, on every tile so they all keep
+                # the same dtype and nodata
+                for var in data.data_vars:
+                    var_data = data[[var]]
+                    if tiled:
+                        nodata = get_nodata(data[var])
+                        if nodata is None:
+                            dtype, nodata = dtype_nodata(data[var].dtype)
+                            var_data[var] = var_data[var].astype(dtype).assign_attrs(nodata=nodata)
+                        var_data = var_data.reindex(time=grouped.time.values, fill_value=nodata)
+                    yield index, var_data, None, stack_names[var], dict(stack_tags, **extra_tags)
+            elif composite_options is None:
+                for i, dt in enumerate(data.time):
+                    ds, tag = time_slice_names(dt)
+                    yield index, data, i, ds, dict(extra_tags, TIFFTAG_DATETIME=tag)
+            else:
+                yield index, composite(data, *composite_options), None, composite_ds, dict(composite_tags, **extra_tags)
+
+        def write_output(job):
+            index, data, i, ds, tags = job
+
+            if index is None:
+                raster_path = basepath.format(ds) + '.tif'
+            else:
+                tile_folder = Path(basepath.format(ds) + '_tiles')
+                tile_folder.mkdir(exist_ok=True)
+                raster_path = str(tile_folder / '{}_{}.tif'.format(*index))
+
+            # Pixels, tags, statistics and overviews are all written in a single pass
+            with labelled(product=product, output=ds):
+                write_geotiff(data, raster_path, time_index=i, overwrite=True, tags=tags, **write_options)
+
+            return ds, tags, raster_path
+
+        def add_output(ds, raster_path):
+            # The manifest is updated as each output is finished, so it's accurate if the run is interrupted
+            outputs[ds] = raster_path
+            if ds in entries:
+                manifest[ds] = dict(entries[ds], path=Path(raster_path).name)
+                write_manifest(manifest_path, manifest)
+
+        feedback.setProgressText('Saving outputs for {}'.format(product))
+
+        def njobs(data):
+            # A composite is one output per tile, a stack is one per measurement, otherwise there's one per time slice
+            if composite_options is not None or (stack and expression is not None):
+                return 1
+            return len(data.data_vars) if stack else max(len(data.time), 1)
+
+        ntotal = len(outputs) + sum(njobs(data) for _, data in tiles)
+        nreused = len(outputs)
+        written = {}  # {ds: (tags, [raster_path, ...])}
+        for index, data in tiles:
+            if feedback.isCanceled():
+                break
+
+            # Reserve enough of the memory budget for the time slices that may be in memory at once,
+            # concurrent products wait here until there's room
+            ntile_times = max(len(data.time), 1)
+            nbytes = data.nbytes // ntile_times * min(ntile_times, max(output_workers, 1))
+            with budget.reserve(nbytes):
+
+                # Outputs are written concurrently, but results come back in order
+                # and outputs already being written are finished if the user cancels
+                results = bounded_imap(write_output, output_jobs(index, data),
+                                       max_workers=output_workers, is_canceled=feedback.isCanceled)
+
+                for ds, tags, raster_path in results:
+                    written.setdefault(ds, (tags, []))[1].append(raster_path)
+                    if not tiled:
+                        add_output(ds, raster_path)
+                    set_progress((nreused + sum(len(paths) for _, paths in written.values())) / ntotal)
+
+        # Tiles are stitched back together with a VRT mosaic for each output,
+        # unless the run was cancelled and some tiles are missing
+        if tiled and not feedback.isCanceled():
+            for ds in sorted(written):
+                tags, raster_paths = written[ds]
+                raster_path = basepath.format(ds) + '.vrt'
+                build_vrt(raster_path, raster_paths, tags=tags)
+                add_output(ds, raster_path)
+
+        for ds in sorted(outputs):
+            output_layers[outputs[ds]] = basename.format(ds)
+
+        set_progress(1)
 
-                if feedback.isCanceled():
-                    return output_layers
+        return output_layers
 
-            feedback.setProgress(int((idx + 1) * 10 * progress_total))
+    @staticmethod
+    def report_timings(timings, products, feedback):
+        """
+        Report where the time went for each product and each of its outputs
 
-        return output_layers
+        :param datacube_query.timing.Timings timings: Timings recorded during the run.
+        :param products: Product names.
+        :param qgis.core.QgsProcessingFeedback feedback: For providing feedback from a processing algorithm
+        """
+        def describe(stages):
+            descs = []
+            for stage, totals in stages.items():
+                desc = '{} {:.2f} s'.format(stage, totals['seconds'])
+                if totals['count'] > 1:
+                    desc += ' in {} calls'.format(totals['count'])
+                for counter, label in (('bytes_planned', 'planned'), ('bytes_in_memory', 'in memory'),
+                                       ('bytes_written', 'written')):
+                    if totals.get(counter):
+                        desc += ', {} {}'.format(format_bytes(totals[counter]), label)
+                descs.append(desc)
+            return '; '.join(descs)
+
+        for product in products:
+            stages = timings.summary(product=product)
+            if not stages:
+                continue
+            feedback.pushInfo('Timings for {}: {}'.format(product, describe(stages)))
+
+            # Peak RSS is for the whole process, including any products processed at the same time
+            # and everything before this run, so it can't be attributed to a product or output
+            peak_rss = max(totals['process_peak_rss'] or 0 for totals in stages.values())
+            if peak_rss:
+                feedback.pushInfo('Process-wide peak memory (RSS) after processing {}: {}'.format(
+                    product, format_bytes(peak_rss)))
+
+            for output in timings.values('output', product=product):
+                feedback.pushInfo('Timings for {} {}: {}'.format(
+                    product, output, describe(timings.summary(product=product, output=output))))
@@ -0,0 +1,315 @@
+from bisect import bisect_left
+from collections import defaultdict
+from hashlib import sha1
+import json
+import os
+from pathlib import Path
+import re
+from time import time
+
+from qgis.core import (
+    QgsApplication,
+    QgsLogger,
+    QgsTask)
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+
+from .defaults import CATALOGUE_CACHE_TTL
+from .utils import (
+    checkout_datacube,
+    get_products_and_measurements)
+
+_loader = None
+
+
+class CatalogueLoader(QObject):
+    """
+    Load the product catalogue in a background task so the GUI isn't blocked
+    while the index database is queried.
+
+    :attr:`products` is replaced with a new dict when the catalogue changes and
+    :attr:`loaded` is emitted. A dict is never modified once it's been assigned, so
+    a reference read from :attr:`products` is a consistent snapshot, even while a
+    refresh is running in the background.
+    """
+
+    loaded = pyqtSignal()
+
+    NO_CONNECTION = 'Unable to connect to a running Data Cube instance'
+
+    def __init__(self):
+        super().__init__()
+
+        self.products = {}
+        self.loading = False
+
+        self._config = None
+        self._task = None
+
+    def load(self, config=None, cache_dir=None, ttl=CATALOGUE_CACHE_TTL):
+        """
+        Start loading the catalogue.
+
+        Any cached catalogue is used immediately and then refreshed in the background
+        if it's older than ``ttl`` seconds.
+
+        :param str config: Datacube config filepath or None.
+        :param Union(str, Path) cache_dir: Cache directory or None to disable caching.
+        :param float ttl: Seconds a cached catalogue is used without checking the index.
+        """
+        if self.loading and config == self._config:
+            return
+
+        if config != self._config:
+            self._config = config
+            self._update({})
+
+        cache = None
+        if cache_dir is not None:
+            cache = read_catalogue_cache(catalogue_cache_file(cache_dir, config))
+            if cache is not None:
+                self._update(cache['products'])
+                if time() - cache['timestamp'] < ttl:
+                    return
+
+        self.loading = True
+        self._task = QgsTask.fromFunction(
+            'Loading Open Data Cube products', self._fetch, config, cache_dir, ttl,
+            on_finished=self._finished)
+        # noinspection PyArgumentList
+        QgsApplication.taskManager().addTask(self._task)
+
+    def items(self):
+        """
+        Get the product and measurement descriptions to display
+
+        :rtype: dict
+        """
+        return catalogue_items(self.products)
+
+    @staticmethod
+    def _fetch(task, config, cache_dir, ttl):
+        return config, get_catalogue(config=config, cache_dir=cache_dir, ttl=ttl)
+
+    def _finished(self, exception, result=None):
+        from sqlalchemy.exc import SQLAlchemyError  # Deferred so loading the plugin doesn't import sqlalchemy
+
+        self.loading = False
+        self._task = None
+
+        if exception is not None:
+            if isinstance(exception, SQLAlchemyError):
+                msg = self.NO_CONNECTION
+            else:
+                msg = 'Unable to load Data Cube products: {}'.format(exception)
+            QgsLogger().warning(msg)
+            if not self.products:
+                self._update({msg: {'measurements': {}}})
+        elif result is not None:
+            config, products = result
+            if config == self._config:  # Ignore results for a config that's since been changed
+                self._update(products)
+
+    def _update(self, products):
+        if products == self.products:
+            return
+        self.products = dict(products)  # Swapped in a single step so readers never see a partial catalogue
+        self.loaded.emit()
+
+
+class CatalogueSearchIndex(object):
+    """
+    Index of the lower-cased words in product and measurement descriptions for fast searching.
+
+    Product descriptions include the product name, and measurement descriptions include the
+    measurement aliases (see :func:`datacube_query.utils.measurement_desc`), so a product can
+    be found by any of them.
+    """
+
+    def __init__(self, items=None):
+        """
+        :param dict items: {product_description: [measurement_description, ...]},
+            see :func:`catalogue_items`.
+        """
+        self._products = defaultdict(set)  # {token: {product_description, ...}}
+        for product, measurements in (items or {}).items():
+            for text in [product] + list(measurements):
+                for token in search_tokens(text):
+                    self._products[token].add(product)
+        self._tokens = sorted(self._products)
+
+    def search(self, text):
+        """
+        Find the products that match every word in some search text.
+
+        A word matches a product if it's the start of a word in the product's
+        description or one of its measurement descriptions.
+
+        :param str text: Search text, e.g. "nbart swir".
+
+        :return: Matching product descriptions, or None if the text has no words to search for.
+        :rtype: Union(set[str], None)
+        """
+        matches = None
+        for term in search_tokens(text):
+            products = set()
+            for i in range(bisect_left(self._tokens, term), len(self._tokens)):
+                if not self._tokens[i].startswith(term):
+                    break
+                products |= self._products[self._tokens[i]]
+
+            matches = products if matches is None else matches & products
+            if not matches:
+                break
+
+        return matches
+
+
+def catalogue_cache_file(cache_dir, config=None):
+    """
+    Get the catalogue cache filepath for a datacube config
+
+    :param Union(str, Path) cache_dir: Cache directory.
+    :param str config: Datacube config filepath or None.
+
+    :return: Cache filepath.
+    :rtype: Path
+    """
+    key = sha1(str(config).encode('utf-8')).hexdigest()
+    return Path(cache_dir, 'catalogue_{}.json'.format(key))
+
+
+def catalogue_fingerprint(config=None):
+    """
+    Get a fingerprint of the products in a datacube index.
+
+    This is much cheaper than :func:`datacube_query.utils.get_products_and_measurements`
+    as it only lists the products and doesn't need to list and join the measurements.
+    Each product is identified by its name, id and when it was last updated in the index,
+    its definition is only hashed if the index doesn't record when it was updated.
+
+    :param str config: Datacube config filepath or None.
+
+    :return: Fingerprint that changes when a product is added, removed or modified.
+    :rtype: str
+    """
+    with checkout_datacube(config=config) as dc:
+        products = dc.index.products.get_all()
+
+    checksum = sha1()
+    for product in sorted(products, key=lambda p: p.name):
+        updated = getattr(product, 'updated', None)
+        version = product.definition if updated is None else updated
+        checksum.update(json.dumps([product.name, getattr(product, 'id', None), version],
+                                   sort_keys=True, default=str).encode('utf-8'))
+    return checksum.hexdigest()
+
+
+def catalogue_items(products):
+    """
+    Get the product and measurement descriptions to display from a catalogue
+
+    :param dict products: A dict of products and measurements,
+        see :func:`datacube_query.utils.get_products_and_measurements`.
+
+    :return: {product_description: [measurement_description, ...]}
+    :rtype: dict
+    """
+    items = defaultdict(list)
+    for k, v in products.items():
+        items[k] += v['measurements'].keys()
+    return items
+
+
+def get_catalogue(config=None, cache_dir=None, ttl=CATALOGUE_CACHE_TTL):
+    """
+    Get a dict of products and measurements, using a cached copy when possible.
+
+    A cached catalogue younger than ``ttl`` seconds is returned without touching the index.
+    An older cached catalogue is returned if :func:`catalogue_fingerprint` shows the
+    products haven't changed, otherwise the catalogue is rebuilt and the cache updated.
+
+    :param str config: Datacube config filepath or None.
+    :param Union(str, Path) cache_dir: Cache directory or None to disable caching.
+    :param float ttl: Seconds a cached catalogue is used without checking the index.
+
+    :return: A dict of products and measurements,
+        see :func:`datacube_query.utils.get_products_and_measurements`.
+    :rtype: dict
+    """
+    if cache_dir is None:
+        return get_products_and_measurements(config=config)
+
+    cache_file = catalogue_cache_file(cache_dir, config)
+    cache = read_catalogue_cache(cache_file)
+
+    if cache is not None and time() - cache['timestamp'] < ttl:
+        return cache['products']
+
+    fingerprint = catalogue_fingerprint(config)
+    if cache is None or cache['fingerprint'] != fingerprint:
+        products = get_products_and_measurements(config=config)
+    else:
+        products = cache['products']
+
+    write_catalogue_cache(cache_file, products, fingerprint)
+
+    return products
+
+
+def get_catalogue_loader():
+    """
+    Get the shared catalogue loader
+
+    :rtype: CatalogueLoader
+    """
+    global _loader
+    if _loader is None:
+        _loader = CatalogueLoader()
+    return _loader
+
+
+def read_catalogue_cache(cache_file):
+    """
+    Read a cached catalogue.
+
+    :param Union(str, Path) cache_file: Cache filepath.
+
+    :return: Cached catalogue {'timestamp': float, 'fingerprint': str, 'products': dict}
+        or None if the cache doesn't exist or can't be read.
+    :rtype: Union(dict, None)
+    """
+    try:
+        with open(str(cache_file)) as f:
+            cache = json.load(f)
+        return {k: cache[k] for k in ('timestamp', 'fingerprint', 'products')}
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def search_tokens(text):
+    """
+    Split text into lower-cased words for searching, e.g. "ls8_nbart_scene" into ["ls8", "nbart", "scene"]
+
+    :param str text: Text.
+
+    :rtype: list[str]
+    """
+    return [token for token in re.split(r'[^0-9a-z]+', text.lower()) if token]
+
+
+def write_catalogue_cache(cache_file, products, fingerprint):
+    """
+    Write a catalogue to the cache.
+
+    :param Union(str, Path) cache_file: Cache filepath.
+    :param dict products: A dict of products and measurements.
+    :param str fingerprint: Fingerprint from :func:`catalogue_fingerprint`.
+    """
+    cache_file = Path(cache_file)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write to a temporary file and rename so a concurrent reader never sees a partial cache
+    tmp_file = cache_file.with_suffix('.{}.tmp'.format(os.getpid()))
+    with open(str(tmp_file), 'w') as f:
+        json.dump({'timestamp': time(), 'fingerprint': fingerprint, 'products': products}, f)
+    os.replace(str(tmp_file), str(cache_file))
@@ -1,14 +1,28 @@
 from collections import OrderedDict
-from rasterio.enums import Resampling, Compression
-from datacube.helpers import ga_pq_fuser
+import os
 
 
 HELP_URL = 'http://datacube-qgis.readthedocs.io/en/latest'
 SETTINGS_GROUP = 'Open Data Cube'
 
-GTIFF_COMPRESSION = [c.value for c in Compression]
-GTIFF_OVR_RESAMPLING = {r.name: r for r in Resampling}
+CATALOGUE_CACHE_TTL = 3600  # seconds a cached product catalogue is used without checking the index
 
+DASK_CHUNK_BLOCKS = 8  # GeoTIFF blocks along each side of a dask chunk
+
+DATACUBE_APP = 'QGIS Plugin'
+DATACUBE_POOL_MAX_IDLE = 1800  # seconds before an unused connection is closed
+DATACUBE_POOL_PING_AFTER = 60  # seconds before an unused connection is checked before reuse
+
+OUTPUT_WORKERS = min(4, os.cpu_count() or 1)  # Output rasters written concurrently
+GDAL_CACHEMAX = 512  # MB of GDAL block cache for writing and overview building
+GDAL_THREADS = max(1, (os.cpu_count() or 1) // OUTPUT_WORKERS)  # Compression threads per output raster
+
+MEMORY_BUDGET = 4096  # MB of data held in memory by concurrently processed products
+PRODUCT_WORKERS = 1  # Products queried and written concurrently
+
+PIXEL_CACHE_SIZE = 10240  # MB of loaded pixels cached on disk
+
+PREVIEW_SCALE = 16  # Preview pixel size as a multiple of the output pixel size
 
 GTIFF_DEFAULTS = {"driver": "GTiff",
                   "interleave": "band", "tiled": True,
@@ -21,10 +35,46 @@ GTIFF_DEFAULTS = {"driver": "GTiff",
                   'photometric': 'RGBA',
                   }
 
+# Profile keys that aren't creation options when copying to a Cloud Optimized GeoTIFF
+COG_EXCLUDE_OPTIONS = ('driver', 'width', 'height', 'count', 'dtype', 'crs', 'transform', 'nodata')
+
+OUTPUT_FORMATS = OrderedDict(
+    [
+        ('GeoTIFF', 'GTiff'),
+        ('Cloud Optimized GeoTIFF', 'COG'),
+    ])
+
+OUTPUT_LAYOUTS = OrderedDict(
+    [
+        ('One GeoTIFF per date', 'date'),
+        ('One multi-band GeoTIFF per measurement, with a band per date', 'stack'),
+    ])
+
+COMPOSITES = OrderedDict(
+    [
+        ('None', None),
+        ('Median', 'median'),
+        ('Mean', 'mean'),
+        ('Minimum', 'min'),
+        ('Maximum', 'max'),
+        ('Percentile', 'percentile'),
+    ])
+
 GTIFF_OVR_DEFAULTS = {'resampling': 'average',
                       'factors': [2, 4, 8, 16, 32],
                       'internal_storage': True}
 
+
+def ga_pq_fuser(dest, src):
+    """
+    Fuse GA PQ data, see :func:`datacube.helpers.ga_pq_fuser`.
+
+    datacube is only imported when data is fused, so importing the defaults is fast.
+    """
+    from datacube.helpers import ga_pq_fuser as _ga_pq_fuser
+    return _ga_pq_fuser(dest, src)
+
+
 GROUP_BY_FUSE_FUNC = OrderedDict(
     [
         ('Solar Day', ('solar_day', None)), #default in datacube-qgis
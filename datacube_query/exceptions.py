@@ -3,4 +3,8 @@ class NoDataError(RuntimeError):
 
 
 class TooManyDatasetsError(RuntimeError):
-    pass
\ No newline at end of file
+    pass
+
+
+class TooMuchDataError(RuntimeError):
+    pass
@@ -0,0 +1,176 @@
+from hashlib import sha1
+import json
+import os
+from pathlib import Path
+
+MANIFEST_VERSION = 1
+
+
+def _json_default(obj):
+    # Fuser functions and other objects in queries are identified by name
+    return getattr(obj, '__name__', str(obj))
+
+
+def _fingerprint(obj):
+    return sha1(json.dumps(obj, sort_keys=True, default=_json_default).encode('utf-8')).hexdigest()
+
+
+def dataset_version(dataset):
+    """
+    Get a string that changes when a dataset is updated in the index
+
+    :param datacube.model.Dataset dataset: Dataset.
+
+    :rtype: str
+    """
+    updated = getattr(dataset, 'updated', None) or getattr(dataset, 'indexed_time', None)
+    return str(updated)
+
+
+def journal_file(output_folder):
+    """
+    Get the run journal filepath for an output folder
+
+    :param Union(str, Path) output_folder: Output folder.
+
+    :rtype: Path
+    """
+    return Path(output_folder, 'datacube_journal.json')
+
+
+def manifest_entry(query, write_options, datasets):
+    """
+    Get the manifest entry for an output time slice
+
+    :param dict query: Query, see :func:`datacube_query.utils.build_query`.
+        The time range and dask chunks don't affect an output, so they're ignored.
+    :param dict write_options: Options for :func:`datacube_query.utils.write_geotiff`.
+        The number of threads doesn't affect an output, so it's ignored.
+    :param datasets: Datasets fused into the time slice.
+
+    :return: {'query': fingerprint, 'options': fingerprint, 'datasets': {id: version}}
+    :rtype: dict
+    """
+    return {
+        'query': _fingerprint({k: v for k, v in query.items() if k not in ('time', 'dask_chunks')}),
+        'options': _fingerprint({k: v for k, v in write_options.items() if k != 'threads'}),
+        'datasets': {str(ds.id): dataset_version(ds) for ds in datasets},
+    }
+
+
+def manifest_file(output_folder, product):
+    """
+    Get the manifest filepath for a product's outputs
+
+    :param Union(str, Path) output_folder: Output folder.
+    :param str product: Product name.
+
+    :rtype: Path
+    """
+    return Path(output_folder, '{}_manifest.json'.format(product))
+
+
+def read_journal(filepath):
+    """
+    Read a run journal.
+
+    :param Union(str, Path) filepath: Journal filepath.
+
+    :return: {'run': fingerprint, 'finished': bool}, empty if the journal doesn't exist or can't be read.
+    :rtype: dict
+    """
+    try:
+        with open(str(filepath)) as f:
+            journal = json.load(f)
+        return {k: journal[k] for k in ('run', 'finished')}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def read_manifest(filepath):
+    """
+    Read a manifest.
+
+    :param Union(str, Path) filepath: Manifest filepath.
+
+    :return: {date: entry} where each entry is from :func:`manifest_entry`
+        with the output ``path`` relative to the manifest,
+        empty if the manifest doesn't exist or can't be read.
+    :rtype: dict
+    """
+    try:
+        with open(str(filepath)) as f:
+            manifest = json.load(f)
+        if manifest['version'] != MANIFEST_VERSION:
+            return {}
+        return dict(manifest['outputs'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def run_fingerprint(**params):
+    """
+    Get a fingerprint of the parameters of a run
+
+    :param params: Everything that affects the outputs of a run.
+        The number of threads in the write options doesn't affect the outputs, so it's ignored.
+
+    :rtype: str
+    """
+    params = dict(params)
+    if 'write_options' in params:
+        params['write_options'] = {k: v for k, v in params['write_options'].items() if k != 'threads'}
+    return _fingerprint(params)
+
+
+def up_to_date(manifest, date, entry, output_folder):
+    """
+    Is an existing output up to date
+
+    :param dict manifest: Manifest from :func:`read_manifest`.
+    :param str date: Date of the output.
+    :param dict entry: Expected entry from :func:`manifest_entry`.
+    :param Union(str, Path) output_folder: Output folder.
+
+    :return: Path of the existing output if it's up to date, otherwise None.
+    :rtype: Union(Path, None)
+    """
+    existing = manifest.get(date)
+    if not existing or any(existing.get(k) != v for k, v in entry.items()):
+        return None
+    filepath = Path(output_folder, existing['path'])
+    return filepath if filepath.exists() else None
+
+
+def write_manifest(filepath, manifest):
+    """
+    Write a manifest.
+
+    :param Union(str, Path) filepath: Manifest filepath.
+    :param dict manifest: {date: entry}, see :func:`read_manifest`.
+    """
+    filepath = Path(filepath)
+
+    # Write to a temporary file and rename so an interrupted run never leaves a partial manifest
+    tmp_file = filepath.with_suffix('.{}.tmp'.format(os.getpid()))
+    with open(str(tmp_file), 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'outputs': manifest}, f, indent=1, sort_keys=True)
+    os.replace(str(tmp_file), str(filepath))
+
+
+def write_journal(filepath, run, finished=False):
+    """
+    Write a run journal.
+
+    The journal is written as unfinished when a run starts and finished when it completes,
+    so a run that was cancelled or crashed can be detected and resumed.
+
+    :param Union(str, Path) filepath: Journal filepath.
+    :param str run: Fingerprint from :func:`run_fingerprint`.
+    :param bool finished: Whether the run completed.
+    """
+    filepath = Path(filepath)
+    tmp_file = filepath.with_suffix('.{}.tmp'.format(os.getpid()))
+    with open(str(tmp_file), 'w') as f:
+        json.dump({'run': run, 'finished': finished}, f)
+    os.replace(str(tmp_file), str(filepath))
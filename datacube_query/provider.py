@@ -6,7 +6,10 @@ from processing.core.ProcessingConfig import ProcessingConfig, Setting
 from .algs.query import DataCubeQueryAlgorithm
 
 from .qgisutils import get_icon
-from .defaults import (GTIFF_OVR_DEFAULTS, GTIFF_DEFAULTS, SETTINGS_GROUP)
+from .defaults import (
+    CATALOGUE_CACHE_TTL, GDAL_THREADS, GTIFF_OVR_DEFAULTS, GTIFF_DEFAULTS, MEMORY_BUDGET,
+    OUTPUT_FORMATS, OUTPUT_LAYOUTS, OUTPUT_WORKERS, PIXEL_CACHE_SIZE, PRODUCT_WORKERS, SETTINGS_GROUP)
+from .utils import dispose_datacubes
 
 
 class DataCubeQueryProvider(QgsProcessingProvider):
@@ -31,39 +34,91 @@ class DataCubeQueryProvider(QgsProcessingProvider):
         self.settings = [
             Setting(SETTINGS_GROUP,
                     'datacube_config_file',
-                    self.tr("1. Open Data Cube database config file"),
+                    self.tr("01. Open Data Cube database config file"),
                     default='',
                     valuetype=Setting.FILE),
             Setting(SETTINGS_GROUP,
                     'datacube_max_datasets',
-                    self.tr("2. Maximum datasets to load in a query"),
+                    self.tr("02. Maximum datasets to load in a query"),
                     default=500,
                     valuetype=Setting.INT),
             Setting(SETTINGS_GROUP,
                     'datacube_gtiff_options',
-                    self.tr("3. GeoTiff Creation Options"),
+                    self.tr("03. GeoTiff Creation Options"),
                     default=json.dumps(GTIFF_DEFAULTS),
                     valuetype=Setting.STRING),
+            Setting(SETTINGS_GROUP,
+                    'datacube_output_format',
+                    self.tr("04. Output format"),
+                    default=list(OUTPUT_FORMATS.keys())[0],
+                    valuetype=Setting.SELECTION,
+                    options=list(OUTPUT_FORMATS.keys())),
             Setting(SETTINGS_GROUP,
                     'datacube_build_overviews',
-                    self.tr("4. Build GeoTiff Overviews"),
+                    self.tr("05. Build GeoTiff Overviews"),
                     default=True,
                     valuetype=None),
             Setting(SETTINGS_GROUP,
                     'datacube_gtiff_ovr_options',
-                    self.tr("5. GeoTiff Overview Options"),
+                    self.tr("06. GeoTiff Overview Options"),
                     default=json.dumps(GTIFF_OVR_DEFAULTS),
                     valuetype=Setting.STRING),
             Setting(SETTINGS_GROUP,
                     'datacube_calculate_statistics',
-                    self.tr("6. Calculate GeoTiff statistics"),
+                    self.tr("07. Calculate GeoTiff statistics"),
                     default=True,
                     valuetype=None),
             Setting(SETTINGS_GROUP,
-                    'datacube_approx_statistics',
-                    self.tr("7. Statistics will be calculated approximately (faster)"),
+                    'datacube_catalogue_cache_ttl',
+                    self.tr("08. Product list cache lifetime in seconds (0 to always check for changes)"),
+                    default=CATALOGUE_CACHE_TTL,
+                    valuetype=Setting.INT),
+            Setting(SETTINGS_GROUP,
+                    'datacube_output_workers',
+                    self.tr("09. Number of output GeoTiffs to write in parallel"),
+                    default=OUTPUT_WORKERS,
+                    valuetype=Setting.INT),
+            Setting(SETTINGS_GROUP,
+                    'datacube_gdal_threads',
+                    self.tr("10. Number of compression and overview threads per output GeoTiff"),
+                    default=GDAL_THREADS,
+                    valuetype=Setting.INT),
+            Setting(SETTINGS_GROUP,
+                    'datacube_product_workers',
+                    self.tr("11. Number of products to query in parallel"),
+                    default=PRODUCT_WORKERS,
+                    valuetype=Setting.INT),
+            Setting(SETTINGS_GROUP,
+                    'datacube_memory_budget',
+                    self.tr("12. Memory budget in MB"),
+                    default=MEMORY_BUDGET,
+                    valuetype=Setting.INT),
+            Setting(SETTINGS_GROUP,
+                    'datacube_auto_tile',
+                    self.tr("13. Split queries too large for the memory budget into tiles"),
                     default=True,
                     valuetype=None),
+            Setting(SETTINGS_GROUP,
+                    'datacube_pixel_cache_dir',
+                    self.tr("14. Pixel cache folder (leave blank to not cache loaded data)"),
+                    default='',
+                    valuetype=Setting.FOLDER),
+            Setting(SETTINGS_GROUP,
+                    'datacube_pixel_cache_size',
+                    self.tr("15. Pixel cache size in MB"),
+                    default=PIXEL_CACHE_SIZE,
+                    valuetype=Setting.INT),
+            Setting(SETTINGS_GROUP,
+                    'datacube_output_layout',
+                    self.tr("16. Output layout"),
+                    default=list(OUTPUT_LAYOUTS.keys())[0],
+                    valuetype=Setting.SELECTION,
+                    options=list(OUTPUT_LAYOUTS.keys())),
+            Setting(SETTINGS_GROUP,
+                    'datacube_timing_trace',
+                    self.tr("17. Write a timing trace to the output folder"),
+                    default=False,
+                    valuetype=None),
         ]
 
         ProcessingConfig.settingIcons[DataCubeQueryProvider.NAME] = self.icon()
@@ -79,6 +134,8 @@ class DataCubeQueryProvider(QgsProcessingProvider):
         for setting in self.settings:
             ProcessingConfig.removeSetting(setting.name)
 
+        dispose_datacubes()
+
     def name(self):
         return DataCubeQueryProvider.NAME
 
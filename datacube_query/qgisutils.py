@@ -3,12 +3,24 @@ from pathlib import Path
 
 from processing.core.ProcessingConfig import ProcessingConfig
 
+from qgis.core import QgsApplication
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtCore import QUrl
 
 from .defaults import HELP_URL
 
 
+def get_cache_dir():
+    """
+    Get the plugin cache directory in the active QGIS user profile
+
+    :return: Cache directory path
+    :rtype: pathlib.Path
+    """
+    # noinspection PyArgumentList
+    return Path(QgsApplication.qgisSettingsDirPath(), 'cache', 'datacube_query')
+
+
 def get_help(alg_class):
     """
     Get help URL
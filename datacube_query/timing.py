@@ -0,0 +1,216 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+_local = threading.local()  # Registry being recorded to and labels for the stages timed in each thread
+
+
+class Timings:
+    """
+    Thread safe record of the wall time and counters (e.g. bytes written) of each stage of a run,
+    and the peak resident memory of the whole process when each stage finished.
+
+    Stages are timed with :func:`timed` while the registry is :func:`recording` in the same thread,
+    or in functions run in other threads that were wrapped with :func:`bind`, so concurrent runs
+    each record to their own registry.
+    """
+    def __init__(self):
+        self.events = []  # [{'stage', 'start', 'end', 'thread', 'labels', 'counters', 'process_peak_rss'}]
+        self._lock = threading.Lock()
+        self._origin = perf_counter()
+
+    def add(self, stage, start, end, labels=None, counters=None):
+        """
+        Record a stage.
+
+        :param str stage: Stage name.
+        :param float start: Start time from :func:`time.perf_counter`.
+        :param float end: End time from :func:`time.perf_counter`.
+        :param dict labels: Labels, e.g. {'product': 'ls8_nbart_albers', 'output': '2001-01-01'}.
+        :param dict counters: Numeric counters, e.g. {'bytes_written': 1024}.
+        """
+        event = {'stage': stage, 'start': start - self._origin, 'end': end - self._origin,
+                 'thread': threading.get_ident(), 'labels': dict(labels or {}),
+                 'counters': dict(counters or {}), 'process_peak_rss': peak_memory()}
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self, **labels):
+        """
+        Get the totals for each stage of the events with the given labels
+
+        :param labels: Labels to match, e.g. product='ls8_nbart_albers'.
+
+        :return: {stage: {'count': int, 'seconds': float, 'process_peak_rss': int, counter: total, ...}}
+            in the order the stages were first recorded. ``process_peak_rss`` is the peak memory of the
+            whole process, including anything running at the same time, not of the stage itself.
+        :rtype: collections.OrderedDict
+        """
+        stages = OrderedDict()
+        for event in self._matching(labels):
+            totals = stages.setdefault(event['stage'], {'count': 0, 'seconds': 0.0, 'process_peak_rss': None})
+            totals['count'] += 1
+            totals['seconds'] += event['end'] - event['start']
+            if event['process_peak_rss'] is not None:
+                totals['process_peak_rss'] = max(totals['process_peak_rss'] or 0, event['process_peak_rss'])
+            for counter, value in event['counters'].items():
+                totals[counter] = totals.get(counter, 0) + value
+        return stages
+
+    def values(self, label, **labels):
+        """
+        Get the values of a label of the events with the given labels
+
+        :param str label: Label name, e.g. 'output'.
+        :param labels: Labels to match, e.g. product='ls8_nbart_albers'.
+
+        :return: Values in the order they were first recorded.
+        :rtype: list
+        """
+        values = OrderedDict()
+        for event in self._matching(labels):
+            if label in event['labels']:
+                values[event['labels'][label]] = None
+        return list(values)
+
+    def write_trace(self, filepath):
+        """
+        Write the events in Chrome trace event format,
+        which can be viewed in chrome://tracing or https://ui.perfetto.dev
+
+        :param Union(str, Path) filepath: Trace filepath.
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+
+        trace = []
+        for event in events:
+            args = dict(event['labels'], **event['counters'])
+            if event['process_peak_rss'] is not None:
+                args['process_peak_rss'] = event['process_peak_rss']
+            trace.append({'name': event['stage'], 'cat': 'datacube_query', 'ph': 'X',
+                          'ts': event['start'] * 1e6, 'dur': (event['end'] - event['start']) * 1e6,
+                          'pid': pid, 'tid': event['thread'], 'args': args})
+
+        with open(str(filepath), 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f, default=str)
+
+    def _matching(self, labels):
+        with self._lock:
+            events = list(self.events)
+        return [e for e in events if all(e['labels'].get(k) == v for k, v in labels.items())]
+
+
+def bind(func):
+    """
+    Wrap a function so the stages it times are recorded to this thread's registry, with this thread's labels,
+    when it's called in another thread, e.g. by a worker pool.
+
+    :param callable func: Function.
+
+    :rtype: callable
+    """
+    timings, labels = getattr(_local, 'timings', None), getattr(_local, 'labels', {})
+
+    @wraps(func)
+    def bound(*args, **kwargs):
+        previous = getattr(_local, 'timings', None), getattr(_local, 'labels', {})
+        _local.timings, _local.labels = timings, labels
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.timings, _local.labels = previous
+
+    return bound
+
+
+@contextmanager
+def labelled(**labels):
+    """
+    Label the stages timed in this thread, e.g. with the product and output being processed
+
+    :param labels: Labels, added to any labels already set in this thread.
+    """
+    previous = getattr(_local, 'labels', {})
+    _local.labels = dict(previous, **labels)
+    try:
+        yield
+    finally:
+        _local.labels = previous
+
+
+def peak_memory():
+    """
+    Get the peak resident memory of this process
+
+    :return: Bytes, or None if it can't be measured on this platform.
+    :rtype: Union(int, None)
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024  # bytes on macOS, KB elsewhere
+
+
+@contextmanager
+def recording(timings):
+    """
+    Record the stages timed in this thread, and in functions wrapped with :func:`bind` in it, in a registry.
+
+    :param Timings timings: Registry.
+    """
+    previous = getattr(_local, 'timings', None)
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time a stage of a run, and record any counters set while it runs, e.g.
+
+        with timed('write_geotiff') as counters:
+            ...
+            counters['bytes_written'] = os.path.getsize(filename)
+
+    Nothing is recorded unless a registry is :func:`recording`, so it's cheap to leave in place.
+
+    :param str stage: Stage name.
+    """
+    timings = getattr(_local, 'timings', None)
+    counters = {}
+    if timings is None:
+        yield counters
+        return
+
+    start = perf_counter()
+    try:
+        yield counters
+    finally:
+        timings.add(stage, start, perf_counter(), getattr(_local, 'labels', {}), counters)
+
+
+def trace_file(output_folder):
+    """
+    Get the timing trace filepath for an output folder
+
+    :param Union(str, Path) output_folder: Output folder.
+
+    :rtype: Path
+    """
+    return Path(output_folder, 'datacube_trace.json')
@@ -1,10 +1,10 @@
-from collections import defaultdict
 import json
 from pathlib import Path
 
 from qgis.PyQt import uic
-from qgis.PyQt.QtCore import Qt, QDate
-from qgis.PyQt.QtWidgets import QTreeWidgetItem, QTreeWidgetItemIterator
+from qgis.PyQt.QtCore import Qt, QAbstractItemModel, QDate, QModelIndex, QSortFilterProxyModel, QTimer
+
+from ..catalogue import CatalogueSearchIndex
 
 _ui_path = Path(__file__).parent
 
@@ -58,61 +58,279 @@ class WidgetDateRange(BASE_DATE_RANGE, WIDGET_DATE_RANGE):
         return json.dumps(retval)
 
 
+class ProductsModel(QAbstractItemModel):
+    """
+    Checkable tree of products and their measurements.
+
+    Measurement rows are only created when a product is expanded, and checked state is kept in a dict
+    rather than on the rows, so the cost of building the tree and of getting and setting the
+    selections depends on the number of selections rather than the size of the catalogue.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self._data = {}  # {product: [measurements]}
+        self._products = []  # Product rows
+        self._rows = {}  # {product: row}
+        self._fetched = set()  # Products with measurement rows
+        self._checked = {}  # {product: [checked measurements]}, products without measurements map to []
+        self._placeholder = False
+        self._search_index = CatalogueSearchIndex()
+
+    def set_data(self, data=None, placeholder=None):
+        """
+        Reset the tree with no selections
+
+        :param dict data: {product: [measurements]}
+        :param str placeholder: Show an inactive row with this text instead of any products.
+        """
+        self.beginResetModel()
+        self._data = dict(data) if data else {}
+        self._products = [placeholder] if placeholder is not None else list(self._data)
+        self._rows = {product: row for row, product in enumerate(self._products)}
+        self._fetched = set()
+        self._checked = {}
+        self._placeholder = placeholder is not None
+        self._search_index = CatalogueSearchIndex(self._data)
+        self.endResetModel()
+
+    def get_checked(self):
+        """
+        Get the checked products and measurements in tree order
+
+        :return: {product: [measurements]}, including selections for products that aren't in the tree.
+        :rtype: dict
+        """
+        # Products that aren't in the tree sort last, in the order they were selected
+        return {product: list(self._checked[product])
+                for product in sorted(self._checked, key=lambda p: self._rows.get(p, len(self._rows)))}
+
+    def search(self, text):
+        """
+        Find the products matching some search text, see :meth:`CatalogueSearchIndex.search`
+
+        :param str text: Search text.
+
+        :return: Matching products, or None if the text has no words to search for.
+        :rtype: Union(set[str], None)
+        """
+        return self._search_index.search(text)
+
+    def set_checked(self, data):
+        """
+        Check products and measurements, unchecking everything else
+
+        :param dict data: {product: [measurements]}. Selections for products that aren't
+            in the tree are kept, e.g. until the catalogue is loaded.
+        """
+        self._checked = {}
+        for product, measurements in data.items():
+            if product in self._data:
+                measurements = [m for m in self._data[product] if m in measurements]
+                if not measurements and self._data[product]:
+                    continue
+            self._checked[product] = list(measurements)
+
+        if self._products:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self._products) - 1, 0), [Qt.CheckStateRole])
+            for product in self._fetched:
+                parent = self.index(self._rows[product], 0)
+                self.dataChanged.emit(self.index(0, 0, parent), self.index(len(self._data[product]) - 1, 0, parent),
+                                      [Qt.CheckStateRole])
+
+    def _product(self, index):
+        # Measurement indexes point to their product, product indexes don't point to anything
+        return index.internalPointer() if index.isValid() else None
+
+    def canFetchMore(self, parent):
+        if not parent.isValid() or self._product(parent) is not None or self._placeholder:
+            return False
+        product = self._products[parent.row()]
+        return product not in self._fetched and bool(self._data[product])
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        product = self._product(index)
+        if product is None:
+            product = self._products[index.row()]
+            if role == Qt.DisplayRole:
+                return product
+            if role == Qt.CheckStateRole and not self._placeholder:
+                if product not in self._checked:
+                    return Qt.Unchecked
+                if len(self._checked[product]) == len(self._data[product]):
+                    return Qt.Checked
+                return Qt.PartiallyChecked
+        else:
+            measurement = self._data[product][index.row()]
+            if role == Qt.DisplayRole:
+                return measurement
+            if role == Qt.CheckStateRole:
+                return Qt.Checked if measurement in self._checked.get(product, []) else Qt.Unchecked
+
+        return None
+
+    def fetchMore(self, parent):
+        product = self._products[parent.row()]
+        self.beginInsertRows(parent, 0, len(self._data[product]) - 1)
+        self._fetched.add(product)
+        self.endInsertRows()
+
+    def flags(self, index):
+        if not index.isValid() or self._placeholder:
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsUserCheckable
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return bool(self._products)
+        if self._product(parent) is not None or self._placeholder:
+            return False
+        return bool(self._data[self._products[parent.row()]])
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column)
+        return self.createIndex(row, column, self._products[parent.row()])
+
+    def parent(self, index):
+        product = self._product(index)
+        if product is None:
+            return QModelIndex()
+        return self.createIndex(self._rows[product], 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self._products)
+        if self._product(parent) is not None:
+            return 0
+        product = self._products[parent.row()]
+        return len(self._data[product]) if product in self._fetched else 0
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or not self.flags(index) & Qt.ItemIsUserCheckable:
+            return False
+
+        checked = value == Qt.Checked
+        product = self._product(index)
+        if product is None:  # Check or uncheck a product and all its measurements
+            product = self._products[index.row()]
+            if checked:
+                self._checked[product] = list(self._data[product])
+            else:
+                self._checked.pop(product, None)
+            if product in self._fetched:
+                self.dataChanged.emit(self.index(0, 0, index), self.index(len(self._data[product]) - 1, 0, index),
+                                      [Qt.CheckStateRole])
+        else:
+            measurement = self._data[product][index.row()]
+            selected = set(self._checked.get(product, []))
+            if checked:
+                selected.add(measurement)
+            else:
+                selected.discard(measurement)
+            if selected:
+                self._checked[product] = [m for m in self._data[product] if m in selected]
+            else:
+                self._checked.pop(product, None)
+            parent = self.parent(index)
+            self.dataChanged.emit(parent, parent, [Qt.CheckStateRole])
+
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        return True
+
+
+class ProductsFilterModel(QSortFilterProxyModel):
+    """ Show only the products in a :class:`ProductsModel` that match some search text """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._matches = None  # None shows every product
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if source_parent.isValid() or self._matches is None:  # Matching products show all their measurements
+            return True
+        return self.sourceModel().index(source_row, 0).data() in self._matches
+
+    def set_filter(self, text):
+        """
+        :param str text: Search text, see :meth:`ProductsModel.search`.
+        """
+        self._matches = self.sourceModel().search(text)
+        self.invalidateFilter()
+
+
 class WidgetProducts(BASE_PRODUCT, WIDGET_PRODUCT):
 
-    def __init__(self, items=None, *args, **kwargs):
+    FILTER_DELAY = 250  # ms to wait for more typing before filtering the products
+    LOADING = 'Loading products\u2026'
+
+    def __init__(self, items=None, catalogue=None, *args, **kwargs):
+        """
+        :param dict items: {product: [measurements]} to display.
+        :param datacube_query.catalogue.CatalogueLoader catalogue: Optional loader,
+            the tree is rebuilt whenever it loads a new catalogue.
+        """
         super().__init__()
         self.setupUi(self)
 
-        self._data = None
-        self.set_items(items)
+        self._model = ProductsModel(self)
+        self._proxy = ProductsFilterModel(self)
+        self._proxy.setSourceModel(self._model)
+        self.tree_products.setModel(self._proxy)
 
-    def get_checked(self):
-        return self.get_items(flags=QTreeWidgetItemIterator.Checked)
+        self._filter_timer = QTimer(self)
+        self._filter_timer.setSingleShot(True)
+        self._filter_timer.setInterval(self.FILTER_DELAY)
+        self._filter_timer.timeout.connect(self.apply_filter)
+        self.filter_products.textChanged.connect(lambda text: self._filter_timer.start())
 
-    def get_items(self, flags=QTreeWidgetItemIterator.All):
-        """ Returns an iterator over the tree items. """
+        self._catalogue = catalogue
+        if catalogue is not None:
+            catalogue.loaded.connect(self.catalogue_loaded)
 
-        # noinspection PyTypeChecker
-        twit = QTreeWidgetItemIterator(self.tree_products, flags)
+        if not items and catalogue is not None and catalogue.loading:
+            self.set_loading()
+        else:
+            self.set_items(items)
 
-        while twit.value() is not None: #This 'orrible iteration style offends me greatly
-            yield twit.value()
-            twit += 1
+    def apply_filter(self):
+        """ Show only the products that match the filter text """
+        self._filter_timer.stop()
+        self._proxy.set_filter(self.filter_products.text())
+
+    def catalogue_loaded(self):
+        """ Rebuild the tree from the catalogue, keeping the current selections """
+        selected = self.get_value()
+        self.set_items(self._catalogue.items())
+        self.set_value(selected)
 
     def get_value(self):
         """ Return checked """
-        data = defaultdict(list)
-
-        for item in self.get_checked():
-            value = item.text(0)
-            parent = item.parent()
-            if parent is None:
-                _ = data[value]
-            else:
-                data[parent.text(0)].append(value)
-
-        return data
+        return self._model.get_checked()
 
     def set_items(self, data=None):
-        """" Build the tree afresh with no selections """
-        self.tree_products.clear()
+        """" Build the tree afresh with no selections
 
+             :param dict data: {product: [measurements]}
+        """
         data = data if data else {}
-        self._data = json.loads(data) if isinstance(data, str) else data
-
-        for product, measurements in self._data.items():
-            parent = QTreeWidgetItem(self.tree_products)
-            parent.setText(0, product)
-            # noinspection PyTypeChecker
-            parent.setFlags(parent.flags() | Qt.ItemIsTristate | Qt.ItemIsUserCheckable)
+        data = json.loads(data) if isinstance(data, str) else data
+        self._model.set_data(data)
+        self.apply_filter()
 
-            for measurement in measurements:
-                child = QTreeWidgetItem(parent)
-                # noinspection PyTypeChecker
-                child.setFlags(child.flags() | Qt.ItemIsUserCheckable)
-                child.setText(0, measurement)
-                child.setCheckState(0, Qt.Unchecked)
+    def set_loading(self):
+        """ Show a placeholder until the catalogue is loaded """
+        self._model.set_data(placeholder=self.LOADING)
+        self.apply_filter()
 
     def set_value(self, data=None):
         """" Select items in the tree
@@ -121,57 +339,7 @@ class WidgetProducts(BASE_PRODUCT, WIDGET_PRODUCT):
 
         data = data if data else {}
         data = json.loads(data) if isinstance(data, str) else data
-
-        for item in self.get_items():
-            value = item.text(0)
-            parent = item.parent()
-            if parent is None:
-                if value in data:
-                    item.setCheckState(0, Qt.Checked)
-                else:
-                    item.setCheckState(0, Qt.Unchecked)
-            else:
-                parent_value = parent.text(0)
-                if parent_value in data and value in data[parent_value]:
-                    item.setCheckState(0, Qt.Checked)
-                else:
-                    item.setCheckState(0, Qt.Unchecked)
+        self._model.set_checked(data)
 
     def value(self):
         return json.dumps(self.get_value())
-
-
-# # Stub for alternative TreeView widget using Model-View-Controller (MVC) design pattern
-# WIDGET_PRODUCTS, BASE_PRODUCTS = uic.loadUiType(
-#     os.path.join(_ui_path, 'widget_products.ui')) # This is a QTreeView, not a QTreeWidget
-#
-# class WidgetProducts(BASE_PRODUCTS, WIDGET_PRODUCTS):
-#
-#     def __init__(self, data=None, *args, **kwargs):
-#         super().__init__()
-#         self.setupUi(self)
-#
-#         self._data = None
-
-#         self._model = QStandardItemModel()
-#
-#         self.set_data(data)
-#
-#     def set_data(self, data=None):
-#         self._data = data if data else {}
-#         self._model = QStandardItemModel()
-#         self.tree_products.setModel(self._model)
-#         root = self._model.invisibleRootItem()
-#
-#         for product, measurements in self._data.items():
-#             parent = QStandardItem(product)
-#             parent.setFlags(parent.flags() | Qt.ItemIsTristate | Qt.ItemIsUserCheckable)
-#             parent.setCheckState(Qt.Unchecked)
-#             root.appendRow(parent)
-#
-#             for measurement in measurements:
-#                 child = QStandardItem(measurement)
-#                 child.setFlags(child.flags() | Qt.ItemIsUserCheckable)
-#                 #child.setText(0, measurement)
-#                 child.setCheckState(Qt.Unchecked)
-#                 parent.appendRow(child)
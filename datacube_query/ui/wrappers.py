@@ -1,4 +1,5 @@
 from processing.gui.wrappers import WidgetWrapper
+from ..catalogue import get_catalogue_loader
 from .widgets import (
     WidgetDateRange,
     WidgetProducts)
@@ -21,6 +22,6 @@ class WrapperDateRange(WrapperBase):
 class WrapperProducts(WrapperBase):
 
     def createWidget(self, items=None, *args, **kwargs):
-        return WidgetProducts(items, *args, **kwargs)
+        return WidgetProducts(items, get_catalogue_loader(), *args, **kwargs)
 
 
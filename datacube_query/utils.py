@@ -1,28 +1,353 @@
-from collections import defaultdict
+import ast
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from hashlib import sha1
+import importlib
+import math
+import operator
+import os
+import tempfile
+from threading import Condition, Lock
+from time import monotonic
 
-import dask.array as da
-import numpy as np
-from osgeo import gdal  # rasterio can't calc stats... - https://github.com/mapbox/rasterio/issues/244
-import pandas as pd
 from pathlib import Path
-import rasterio as rio
-from rasterio.dtypes import check_dtype
-
-import datacube
-from datacube.api.query import Query
-from datacube.helpers import write_geotiff as _write_geotiff
 
 from .defaults import (
+    COG_EXCLUDE_OPTIONS,
+    DASK_CHUNK_BLOCKS,
+    DATACUBE_APP,
+    DATACUBE_POOL_MAX_IDLE,
+    DATACUBE_POOL_PING_AFTER,
+    GDAL_CACHEMAX,
     GTIFF_OVR_DEFAULTS,
-    GTIFF_DEFAULTS,
-    GTIFF_OVR_RESAMPLING)
+    GTIFF_DEFAULTS)
 from .exceptions import (
     NoDataError,
-    TooManyDatasetsError)
+    TooManyDatasetsError,
+    TooMuchDataError)
+from .manifest import dataset_version
+from .timing import bind, timed
+
+
+class _LazyModule:
+    """
+    Module that's only imported when one of its attributes is first used.
+
+    Importing datacube and the libraries it depends on takes seconds, and this module is imported
+    when QGIS loads the plugin, so they're deferred until a query is actually run.
+    Attributes aren't cached, so patching the real module (e.g. in tests) still works.
+    """
+    def __init__(self, name, *submodules):
+        """
+        :param str name: Module name.
+        :param str submodules: Submodules to import with it, e.g. those not imported by the package itself.
+        """
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            for submodule in self._submodules:
+                importlib.import_module(submodule)
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+affine = _LazyModule('affine')
+da = _LazyModule('dask.array')
+dask = _LazyModule('dask')
+datacube = _LazyModule('datacube', 'datacube.api.core', 'datacube.api.query', 'datacube.utils.geometry')
+gdal = _LazyModule('osgeo.gdal')  # rasterio can't calc stats... - https://github.com/mapbox/rasterio/issues/244
+np = _LazyModule('numpy')
+pd = _LazyModule('pandas')
+rio = _LazyModule('rasterio', 'rasterio.dtypes', 'rasterio.enums', 'rasterio.shutil', 'rasterio.windows')
+sqlalchemy = _LazyModule('sqlalchemy', 'sqlalchemy.exc')
+xr = _LazyModule('xarray')
+
+# Query parameters the output geobox is built from, replaced by a ``like`` geobox
+SPATIAL_QUERY_KEYS = ('x', 'y', 'crs', 'output_crs', 'resolution', 'align', 'like')
+
+# Operators and functions allowed in band math expressions
+_EXPRESSION_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.Pow: operator.pow, ast.USub: operator.neg, ast.UAdd: operator.pos}
+_EXPRESSION_FUNCTIONS = {  # {name: (numpy function name, number of arguments)}
+    'abs': ('abs', 1), 'sqrt': ('sqrt', 1), 'exp': ('exp', 1), 'log': ('log', 1),
+    'min': ('fmin', 2), 'max': ('fmax', 2)}
+
+# Process-wide pool of Datacube instances, {(config, app): [datacube, last_used, users]}
+_datacubes = {}
+_datacubes_lock = Lock()
+_PING_PRODUCT = '__datacube_query_ping__'  # Never found, so the lookup isn't cached and always queries the index
+
+
+class MemoryBudget:
+    """
+    Byte budget shared by concurrent tasks.
+
+    Tasks reserve an estimate of the memory they'll use and wait until enough of the
+    budget is free. A reservation larger than the whole budget waits until nothing
+    else is reserved and then runs alone.
+    """
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+        self.available = nbytes
+        self._condition = Condition()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        nbytes = min(nbytes, self.nbytes)
+        with self._condition:
+            self._condition.wait_for(lambda: self.available >= nbytes)
+            self.available -= nbytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.available += nbytes
+                self._condition.notify_all()
+
+
+class PixelCache:
+    """
+    Size bounded disk cache of loaded pixels, the least recently used entries are evicted first.
+
+    Each entry is a single dask chunk of one time slice of one measurement, keyed by the datasets
+    fused into it and when they were last updated in the index, the measurement, the chunk's window
+    of the output grid and the resampling method, so repeat queries over the same area only read
+    source data for new dates, measurements and chunks.
+
+    The size and least recently used order of the entries are read from the cache folder once,
+    then kept in memory, so adding an entry doesn't list the folder.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+
+        # {key: bytes} in least to most recently used order, from when entries were last used in any session
+        entries = []
+        for filepath in self.path.glob('*.npy'):
+            try:
+                stat = filepath.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, filepath.stem, stat.st_size))
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._nbytes = sum(self._entries.values())
+
+    @staticmethod
+    def key(datasets, measurement, geobox, resampling=None, fuse_func=None):
+        """
+        Get the cache key for a chunk of a time slice
+
+        :param datasets: Datasets fused into the time slice.
+        :param str measurement: Measurement name.
+        :param datacube.utils.geometry.GeoBox geobox: Output grid of the chunk.
+        :param resampling: Resampling method.
+        :param callable fuse_func: Fuser function or None.
+
+        :rtype: str
+        """
+        checksum = sha1()
+        for item in (sorted((str(ds.id), dataset_version(ds)) for ds in datasets), measurement,
+                     str(geobox.crs), tuple(geobox.affine)[:6], geobox.shape,
+                     str(resampling), getattr(fuse_func, '__name__', str(fuse_func))):
+            checksum.update(repr(item).encode('utf-8'))
+        return checksum.hexdigest()
+
+    def get(self, key):
+        """ :return: Cached array or None """
+        filepath = self.path / '{}.npy'.format(key)
+        try:
+            data = np.load(str(filepath))
+            os.utime(str(filepath))  # Mark as recently used for later sessions
+        except (OSError, ValueError):
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        """ Cache an array, then evict the least recently used entries if the cache is over size """
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file and rename so a concurrent reader never sees a partial entry
+        filepath = self.path / '{}.npy'.format(key)
+        # and concurrent writers of the same entry, in any thread or process, never share a temporary file
+        fd, tmp_file = tempfile.mkstemp(prefix='{}.'.format(key), suffix='.tmp', dir=str(self.path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, data)
+            os.replace(tmp_file, str(filepath))
+        except BaseException:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise
+
+        size = os.path.getsize(str(filepath))
+        with self._lock:
+            self._nbytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size  # Most recently used
+
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in max_bytes """
+        with self._lock:
+            while self._entries and self._nbytes > self.max_bytes:
+                key, size = self._entries.popitem(last=False)
+                self._nbytes -= size
+                try:
+                    (self.path / '{}.npy'.format(key)).unlink()
+                except OSError:  # e.g. already removed by another process
+                    pass
+
+
+class _BandStatistics:
+    """
+    Exact band statistics accumulated one block at a time, ignoring nodata and NaN.
+
+    Each block is reduced with vectorised numpy operations and merged into the running
+    totals with the pairwise algorithm of Chan et al. so the mean and standard deviation
+    don't lose precision over many blocks.
+    """
+    def __init__(self, nodata=None):
+        self.nodata = nodata
+        self.total = 0  # All pixels, including nodata
+        self.count = 0  # Valid pixels
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared differences from the mean
+        self.min = None
+        self.max = None
+
+    def update(self, block):
+        block = np.asarray(block)
+        self.total += block.size
+
+        valid = None
+        if block.dtype.kind == 'f':
+            valid = ~np.isnan(block)
+        if self.nodata is not None and not np.isnan(self.nodata):
+            notnodata = block != self.nodata
+            valid = notnodata if valid is None else valid & notnodata
+        if valid is not None:
+            block = block[valid]
+
+        count = block.size
+        if not count:
+            return
+
+        block = block.astype(np.float64, copy=False)
+        mean = block.mean()
+        m2 = np.square(block - mean).sum()
+        bmin, bmax = block.min(), block.max()
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = bmin if self.min is None else min(self.min, bmin)
+        self.max = bmax if self.max is None else max(self.max, bmax)
+
+    def stats(self):
+        """ :return: [min, max, mean, std] or None if there's no valid data """
+        if not self.count:
+            return None
+        std = np.sqrt(self.m2 / self.count)  # Population std dev, as calculated by GDAL
+        return [float(self.min), float(self.max), float(self.mean), float(std)]
+
+    def tags(self):
+        """ :return: GDAL statistics metadata items """
+        stats = self.stats()
+        if stats is None:
+            return {}
+        keys = ('STATISTICS_MINIMUM', 'STATISTICS_MAXIMUM', 'STATISTICS_MEAN', 'STATISTICS_STDDEV')
+        tags = {k: repr(v) for k, v in zip(keys, stats)}
+        tags['STATISTICS_VALID_PERCENT'] = repr(100.0 * self.count / self.total)
+        return tags
+
+
+class _BandWriter:
+    """
+    Array-like target for :func:`dask.array.store` that writes each region to a raster band
+    """
+    def __init__(self, raster, bidx, statistics=None):
+        self.raster = raster
+        self.bidx = bidx
+        self.statistics = statistics
+
+    def __setitem__(self, key, value):
+        self.raster.write(value, self.bidx, window=rio.windows.Window.from_slices(*key))
+        if self.statistics is not None:
+            self.statistics.update(value)
+
+
+def bounded_imap(func, iterable, max_workers=1, is_canceled=None):
+    """
+    Map a function over an iterable in a thread pool, yielding results in input order.
+
+    No more than ``max_workers`` items are in flight at once, which bounds the memory used.
+    Once ``is_canceled`` returns True no more items are started, but items already
+    in flight are finished and yielded so no output is left partially written.
 
+    :param callable func: Function to call with each item.
+    :param iterable: Items.
+    :param int max_workers: Maximum number of items processed concurrently,
+        1 processes items one at a time in the calling thread.
+    :param callable is_canceled: Optional function that returns True to stop processing.
 
-def build_overviews(filename, overview_options=None):
+    :return: Iterator over results, in the same order as the items.
+    """
+    is_canceled = is_canceled or (lambda: False)
+    func = bind(func)  # Stages timed in the pool are recorded to the calling thread's registry
+
+    if max_workers is None or max_workers <= 1:
+        for item in iterable:
+            if is_canceled():
+                return
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in iterable:
+            if is_canceled():
+                break
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def build_dask_chunks(profile_override=None, blocks=DASK_CHUNK_BLOCKS):
+    """
+    Build dask chunks aligned to the GeoTIFF block size so each chunk
+    can be written as whole blocks.
+
+    :param dict profile_override: GeoTIFF creation options that override the defaults.
+    :param int blocks: Number of GeoTIFF blocks along each side of a chunk.
+
+    :return: Dask chunks, one time slice per chunk.
+    :rtype: dict
+    """
+    profile = lcase_dict(GTIFF_DEFAULTS.copy())
+    profile.update(lcase_dict(profile_override or {}))
+
+    return {'time': 1, 'x': profile['blockxsize'] * blocks, 'y': profile['blockysize'] * blocks}
+
+
+def build_overviews(filename, overview_options=None, threads=None):
     """
     Build reduced resolution overviews/pyramids for a raster
 
@@ -35,6 +360,7 @@ def build_overviews(filename, overview_options=None):
 
             {"resampling": "average", "factors": [2, 4, 8, 16, 32], "internal_storage": True}
 
+    :param int threads: Number of threads GDAL may use.
     """
 
     options = GTIFF_OVR_DEFAULTS.copy()
@@ -45,11 +371,12 @@ def build_overviews(filename, overview_options=None):
     else:
         mode = 'r'
 
-    resampling = GTIFF_OVR_RESAMPLING[options['resampling']]
+    resampling = rio.enums.Resampling[options['resampling']]
 
-    with rio.open(filename, mode) as raster:
-        raster.build_overviews(options['factors'], resampling)
-        raster.update_tags(ns='rio_overview', resampling=options['resampling'])
+    with timed('build_overviews'), rio.Env(**gdal_env(threads)):
+        with rio.open(filename, mode) as raster:
+            raster.build_overviews(options['factors'], resampling)
+            raster.update_tags(ns='rio_overview', resampling=options['resampling'])
 
 
 def build_query(
@@ -97,6 +424,33 @@ def build_query(
     return query
 
 
+def build_vrt(filename, sources, tags=None):
+    """
+    Build a VRT mosaic of rasters on the same grid, e.g. tiles written from :func:`run_tiled_query`
+
+    :param Union(str, Path) filename: Output VRT filename.
+    :param list sources: Source raster filenames.
+    :param dict tags: Dataset metadata tags to write.
+    """
+    vrt = gdal.BuildVRT(str(filename), [str(source) for source in sources])
+    if vrt is None:
+        raise RuntimeError('Unable to build VRT "{}"'.format(filename))
+    for key, value in (tags or {}).items():
+        vrt.SetMetadataItem(key, value)
+
+    # Band descriptions and tags, e.g. the dates of a time stack, are the same in every tile.
+    # Tile statistics aren't copied as they don't describe the whole mosaic
+    source = gdal.Open(str(sources[0]))
+    for bandnum in range(1, vrt.RasterCount + 1):
+        band, source_band = vrt.GetRasterBand(bandnum), source.GetRasterBand(bandnum)
+        band.SetDescription(source_band.GetDescription())
+        for key, value in source_band.GetMetadata().items():
+            if not key.startswith('STATISTICS_'):
+                band.SetMetadataItem(key, value)
+    source = None
+    vrt = None  # Close to flush the VRT to disk
+
+
 def calculate_statistics(filepath, approx_ok=True):
     """
     Calculate min,max,mean,std
@@ -108,19 +462,145 @@ def calculate_statistics(filepath, approx_ok=True):
     :rtype: list[list[float]]
     """
     gdal.UseExceptions()
-    try:
-        ds = gdal.OpenEx(filepath, gdal.GA_Update)
-    except AttributeError:  # gdal <= 2.0 (gdal.Open works but is deprecated in 2.x)
-        ds = gdal.Open(filepath, gdal.GA_Update)
+    with timed('calculate_statistics'):
+        try:
+            ds = gdal.OpenEx(filepath, gdal.GA_Update)
+        except AttributeError:  # gdal <= 2.0 (gdal.Open works but is deprecated in 2.x)
+            ds = gdal.Open(filepath, gdal.GA_Update)
 
-    stats = []
-    for i in range(ds.RasterCount):
-        stats.append(ds.GetRasterBand(i + 1).ComputeStatistics(approx_ok))
-    del ds
+        stats = []
+        for i in range(ds.RasterCount):
+            stats.append(ds.GetRasterBand(i + 1).ComputeStatistics(approx_ok))
+        del ds
 
     return stats
 
 
+@contextmanager
+def checkout_datacube(config=None, app=DATACUBE_APP,
+                      max_idle=DATACUBE_POOL_MAX_IDLE, ping_after=DATACUBE_POOL_PING_AFTER):
+    """
+    Check out a pooled Datacube instance for the duration of a ``with`` block, creating one if required.
+
+    Instances are keyed by config and app, so repeated queries reuse the same index database
+    connections. Checked out instances are reference counted, instances nobody has checked out
+    for longer than ``max_idle`` seconds are closed and instances unused for longer than ``ping_after``
+    seconds are checked with :func:`ping_datacube` and replaced if the connection has gone away.
+    Instances are created and checked outside the pool lock, so a slow database doesn't block other threads.
+
+    :param str config: Datacube config filepath or None.
+    :param str app: Application name reported to the index database.
+    :param float max_idle: Seconds before an unused instance is closed.
+    :param float ping_after: Seconds before an unused instance is checked before reuse.
+
+    :return: Context manager yielding a Datacube instance.
+    """
+    key = (config, app)
+    expired = []
+
+    with _datacubes_lock:
+        now = monotonic()
+        for k, (dc, last_used, users) in list(_datacubes.items()):
+            if not users and now - last_used > max_idle:
+                expired.append(_datacubes.pop(k)[0])
+
+        pooled = _datacubes.get(key)
+        check = pooled is not None and now - pooled[1] > ping_after
+        if pooled is not None:  # Marked used, so other threads don't check it too
+            pooled[1] = now
+            pooled[2] += 1
+
+    if check and not ping_datacube(pooled[0]):
+        _release_datacube(key, pooled, retire=True)
+        pooled = None
+
+    if pooled is None:
+        dc = datacube.Datacube(config=config, app=app)
+        with _datacubes_lock:
+            pooled = _datacubes.get(key)
+            if pooled is None:
+                pooled = _datacubes[key] = [dc, monotonic(), 0]
+            else:  # Another thread added one while this one was connecting
+                expired.append(dc)
+            pooled[1] = monotonic()
+            pooled[2] += 1
+
+    for dc in expired:
+        _close_datacube(dc)
+
+    try:
+        yield pooled[0]
+    finally:
+        _release_datacube(key, pooled)
+
+
+def _release_datacube(key, pooled, retire=False):
+    """ Check a [datacube, last_used, users] pool entry back in, it's closed once it's out of the pool and unused """
+    with _datacubes_lock:
+        if retire and _datacubes.get(key) is pooled:
+            del _datacubes[key]
+        pooled[1] = monotonic()
+        pooled[2] -= 1
+        close = not pooled[2] and _datacubes.get(key) is not pooled
+
+    if close:
+        _close_datacube(pooled[0])
+
+
+def composite(dataset, method, percentile=50):
+    """
+    Reduce a dataset along time to a single composite, ignoring nodata.
+
+    The reduction is lazy. Dask backed variables are rechunked to a single chunk along time
+    and automatically sized chunks in space, so the composite is computed a spatial chunk at a
+    time as it's written.
+
+    :param xarray.Dataset dataset: Dataset with a time dimension.
+    :param str method: 'median', 'mean', 'min', 'max' or 'percentile'.
+    :param float percentile: Percentile (0-100) for the 'percentile' method.
+
+    :return: Composite with no time dimension, every variable has the same dtype. Min and max composites
+        keep the dtype and nodata of the variables if they all have nodata and the same dtype,
+        everything else is float32 with NaN nodata.
+    :rtype: xarray.Dataset
+    """
+    # Pixels with no valid data can only be cast back to the original dtype if there's a nodata to set them to
+    keep_dtype = method in ('min', 'max') and _composite_keeps_dtype(
+        [(data.dtype, get_nodata(data)) for data in dataset.data_vars.values()])
+
+    variables = {}
+    for name, data in dataset.data_vars.items():
+        nodata = get_nodata(data)
+        if data.chunks is not None:
+            data = data.chunk({dim: -1 if dim == 'time' else 'auto' for dim in data.dims})
+
+        masked = data.astype(np.float32)
+        if nodata is not None and not np.isnan(nodata):
+            masked = masked.where(data != nodata)
+
+        if method == 'percentile':
+            reduced = masked.quantile(percentile / 100, dim='time', skipna=True).drop_vars('quantile')
+        else:
+            reduced = getattr(masked, method)(dim='time', skipna=True)
+
+        if keep_dtype:
+            reduced = reduced.fillna(nodata).astype(data.dtype)
+            reduced.attrs = dict(data.attrs)
+        else:
+            reduced = reduced.astype(np.float32)  # quantile returns float64
+            reduced.attrs = dict(data.attrs, nodata=np.nan)
+
+        variables[name] = reduced
+
+    return xr.Dataset(variables, attrs=dataset.attrs)
+
+
+def _composite_keeps_dtype(variables):
+    """ Do min and max composites of [(dtype, nodata), ...] variables keep their dtype """
+    return len({np.dtype(dtype) for dtype, _ in variables}) == 1 and all(
+        nodata is not None for _, nodata in variables)
+
+
 def datetime_to_str(datetime64, str_format='%Y-%m-%d'):
     """
     Convert a numpy.datetime64 to a string
@@ -140,6 +620,247 @@ def datetime_to_str(datetime64, str_format='%Y-%m-%d'):
     return dt.strftime(str_format)
 
 
+def _close_datacube(dc):
+    try:
+        dc.close()
+    except (AttributeError, sqlalchemy.exc.SQLAlchemyError):  # datacube < 1.5 has no close method
+        pass
+
+
+def dispose_datacubes():
+    """
+    Close all pooled Datacube connections and empty the pool.
+
+    Instances that are checked out are closed when they're checked back in.
+    """
+    with _datacubes_lock:
+        pooled = list(_datacubes.values())
+        _datacubes.clear()
+
+    for dc, _, users in pooled:
+        if not users:
+            _close_datacube(dc)
+
+
+def estimate_query(query, datasets, concurrency=1, expression=None, composite=None):
+    """
+    Estimate the size of the data a query will load and write, without loading it.
+
+    :param dict query: Query.
+    :param list datasets: Datasets found for the query.
+    :param int concurrency: Number of time slices that will be in memory at once.
+    :param str expression: Band math expression the output is calculated with
+        (see :func:`evaluate_expression`) or None.
+    :param str composite: Temporal composite method the output is reduced with
+        (see :func:`composite`) or None.
+
+    :return: Estimate:
+
+        {'datasets': number of datasets,
+         'timesteps': number of time steps after grouping,
+         'width': output width in pixels,
+         'height': output height in pixels,
+         'pixels': total pixels loaded for all time steps and measurements,
+         'bytes_in_memory': bytes if the whole query was held in memory,
+         'timestep_bytes': bytes of a single time step,
+         'output_timestep_bytes': bytes of a single time step of output, after any expression or composite,
+         'output_bytes': bytes of output before compression and overviews,
+         'peak_bytes': bytes of the time steps and output in memory at once}
+
+    :rtype: dict
+    """
+    product = datasets[0].type
+
+    height, width = query_geobox(query, datasets).shape
+
+    grouped = group_datasets(query, datasets)
+    timesteps = len(grouped.time)
+
+    measurements = product.lookup_measurements(query.get('measurements') or None).values()
+    itemsizes = [np.dtype(m['dtype']).itemsize for m in measurements]
+
+    # An expression is a single float32 band, composites collapse time to a single output and are float32,
+    # except min and max of measurements with the same dtype that all have nodata, which keep their dtype
+    float32_size = np.dtype(np.float32).itemsize
+    if expression is not None:
+        output_itemsizes = [float32_size]
+    elif composite is None or (composite in ('min', 'max') and _composite_keeps_dtype(
+            [(m['dtype'], m.get('nodata')) for m in measurements])):
+        output_itemsizes = itemsizes
+    else:
+        output_itemsizes = [float32_size] * len(itemsizes)
+    output_timesteps = min(timesteps, 1) if composite is not None else timesteps
+
+    timestep_bytes = width * height * sum(itemsizes)
+    output_timestep_bytes = width * height * sum(output_itemsizes)
+    slices = max(min(concurrency, timesteps), 1)
+
+    # Without an expression or composite the output is the loaded data,
+    # otherwise it's calculated alongside it, one output for a composite and one per time slice for an expression
+    if composite is not None:
+        output_slices = 1
+    elif expression is not None:
+        output_slices = slices
+    else:
+        output_slices = 0
+
+    return {
+        'datasets': len(datasets),
+        'timesteps': timesteps,
+        'width': width,
+        'height': height,
+        'pixels': width * height * timesteps * len(itemsizes),
+        'bytes_in_memory': timestep_bytes * timesteps,
+        'timestep_bytes': timestep_bytes,
+        'output_timestep_bytes': output_timestep_bytes,
+        'output_bytes': output_timestep_bytes * output_timesteps,
+        'peak_bytes': timestep_bytes * slices + output_timestep_bytes * output_slices,
+    }
+
+
+def estimate_tile_shape(estimate, max_bytes, tile_align=(256, 256)):
+    """
+    Estimate the largest square tile whose time slices and output in memory at once fit in ``max_bytes``.
+
+    :param dict estimate: Estimate from :func:`estimate_query`.
+    :param int max_bytes: Maximum peak memory in bytes.
+    :param tuple(int, int) tile_align: Tile (rows, cols) are multiples of this.
+
+    :return: Tile shape (rows, cols), at least ``tile_align`` and at most the output shape.
+    :rtype: tuple(int, int)
+    """
+    pixels = max(estimate['width'] * estimate['height'], 1)
+    pixel_bytes = max(estimate['peak_bytes'], 1) / pixels  # Peak memory is proportional to the tile area
+
+    side = int(math.sqrt(max_bytes / pixel_bytes))
+    rows, cols = (max(side // align, 1) * align for align in tile_align)
+
+    return min(rows, estimate['height']), min(cols, estimate['width'])
+
+
+def evaluate_expression(dataset, expression, name='expression', aliases=None):
+    """
+    Evaluate a band math expression, e.g. ``(nir - red) / (nir + red)``, on a dataset.
+
+    The expression is evaluated lazily on dask backed datasets, so the measurements it uses
+    are never written to disk. Nodata is masked in the inputs, and nodata, division by zero
+    and other invalid results are NaN in the output.
+
+    :param xarray.Dataset dataset: Dataset with the measurements used in the expression.
+    :param str expression: Expression, see :func:`parse_expression`.
+    :param str name: Name of the output variable.
+    :param dict aliases: {name used in the expression: measurement name} for names that aren't
+        measurement names, see :func:`expression_aliases`, or None.
+
+    :return: Dataset with a single float32 variable.
+    :rtype: xarray.Dataset
+
+    :raise ValueError: Invalid expression or it uses a measurement that isn't in the dataset
+    """
+    tree, names = parse_expression(expression)
+    measurements = {var: (aliases or {}).get(var, var) for var in names}
+
+    missing = set(measurements.values()) - set(dataset.data_vars)
+    if missing:
+        raise ValueError('Measurements not found for expression: {}'.format(', '.join(sorted(missing))))
+
+    variables = {}
+    for var, measurement in measurements.items():
+        data = dataset[measurement]
+        nodata = get_nodata(data)
+        masked = data.astype(np.float32)
+        if nodata is not None and not np.isnan(nodata):
+            masked = masked.where(data != nodata)
+        variables[var] = masked
+
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Name):
+            return variables[node.id]
+        if _expression_number(node) is not None:
+            return np.float32(_expression_number(node))
+        if isinstance(node, ast.BinOp):
+            return _EXPRESSION_OPERATORS[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp):
+            return _EXPRESSION_OPERATORS[type(node.op)](evaluate(node.operand))
+        if isinstance(node, ast.Call):
+            return getattr(np, _EXPRESSION_FUNCTIONS[node.func.id][0])(*[evaluate(arg) for arg in node.args])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = evaluate(tree)
+    if not isinstance(result, xr.DataArray):  # e.g. the expression only uses constants
+        raise ValueError('Expression must use at least one measurement: {}'.format(expression))
+
+    result = result.where(np.isfinite(result)).astype(np.float32)
+    result.attrs = dict(dataset[measurements[sorted(names)[0]]].attrs, nodata=np.nan)
+    result.attrs.pop('units', None)
+
+    return xr.Dataset({name: result}, attrs=dataset.attrs)
+
+
+def _expression_number(node):
+    """ :return: The value of a number node, or None (``ast.Num`` before Python 3.8, ``ast.Constant`` after) """
+    if isinstance(node, getattr(ast, 'Constant', ())) or type(node).__name__ == 'Num':
+        value = getattr(node, 'value', getattr(node, 'n', None))
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+    return None
+
+
+def expression_aliases(names, measurements):
+    """
+    Match the names used in a band math expression to measurements, by measurement name or alias,
+    e.g. ``red`` to measurement ``4`` of a product with measurement description ``4/band_4/red``.
+
+    :param set names: Names used in the expression, see :func:`parse_expression`.
+    :param dict measurements: {measurement_description: measurement_name},
+        see :func:`get_products_and_measurements` and :func:`measurement_desc`.
+
+    :return: {name: measurement_name} for the names that match a measurement,
+        measurement names take precedence over aliases.
+    :rtype: dict
+    """
+    lookup = {measurement: measurement for measurement in measurements.values()}
+    for desc, measurement in measurements.items():
+        for alias in desc.split('/'):
+            lookup.setdefault(alias, measurement)
+    return {name: lookup[name] for name in names if name in lookup}
+
+
+def format_bytes(nbytes):
+    """
+    Format a number of bytes for display
+
+    :param int nbytes: Number of bytes.
+
+    :rtype: str
+    """
+    if abs(nbytes) < 1024:
+        return '{} B'.format(nbytes)
+    for unit in ('KB', 'MB', 'GB', 'TB'):
+        nbytes /= 1024
+        if abs(nbytes) < 1024:
+            break
+    return '{:.1f} {}'.format(nbytes, unit)
+
+
+def gdal_env(threads=None):
+    """
+    GDAL config options for writing rasters and building overviews.
+
+    :param int threads: Number of threads GDAL may use for compression and overviews,
+        None or 1 for a single thread.
+
+    :return: Config options to pass to :class:`rasterio.Env`.
+    :rtype: dict
+    """
+    env = {'GDAL_CACHEMAX': GDAL_CACHEMAX}
+    if threads is not None and threads > 1:
+        env['GDAL_NUM_THREADS'] = threads
+    return env
+
+
 def get_dtype(dataset):
     try:
         dtypes = {val.dtype for val in dataset.data_vars.values()}
@@ -167,6 +888,27 @@ def get_nodata(data):
         return data.nodata
 
 
+def dtype_nodata(dtype):
+    """
+    Get a dtype and nodata value for data that doesn't have a nodata value, e.g. to fill missing time slices.
+
+    The nodata value is never valid data. Floating point data uses NaN, integers are promoted to
+    a signed integer twice the size with nodata one less than the original dtype's minimum.
+    64 bit integers have no larger integer type and are promoted to float64 with NaN nodata.
+
+    :param dtype: Data type.
+
+    :return: Tuple of the dtype to cast the data to and the nodata value.
+    :rtype: tuple(numpy.dtype, Union(float, int))
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'fc':
+        return dtype, float('nan')
+    if dtype.itemsize >= 8:
+        return np.dtype(np.float64), float('nan')
+    return np.dtype('int{}'.format(dtype.itemsize * 16)), int(np.iinfo(dtype).min) - 1
+
+
 def get_products_and_measurements(config=None):
     """
     Get a dict of products and measurements.
@@ -198,9 +940,9 @@ def get_products_and_measurements(config=None):
 
     proddict = defaultdict(lambda: defaultdict(dict))
 
-    dc = datacube.Datacube(config=config)
-    products = dc.list_products()
-    measurements = dc.list_measurements()
+    with checkout_datacube(config=config) as dc:
+        products = dc.list_products()
+        measurements = dc.list_measurements()
     measurements.reset_index(inplace=True)
     display_columns = ['name', 'description']
     products = products[display_columns]
@@ -221,6 +963,20 @@ def get_products_and_measurements(config=None):
     return proddict
 
 
+def group_datasets(query, datasets):
+    """
+    Group datasets into time slices, as :meth:`datacube.Datacube.load` will.
+
+    :param dict query: Query, the group_by is used.
+    :param list datasets: Datasets.
+
+    :return: Tuples of datasets with a time dimension.
+    :rtype: xarray.DataArray
+    """
+    group_by = datacube.api.query.query_group_by(group_by=query.get('group_by', 'time'))
+    return datacube.Datacube.group_datasets(datasets, group_by)
+
+
 def lcase_dict(adict):
     """
     Convert the keys in a dict to lowercase (if they're strings).
@@ -239,6 +995,70 @@ def lcase_dict(adict):
     return ret_dict
 
 
+def load_cached(datasets, geobox, query, cache):
+    """
+    Lazily load datasets on to a geobox like :meth:`datacube.Datacube.load`, but read each dask chunk
+    of each time slice of each measurement from a :class:`PixelCache` if it's there and cache it when it isn't.
+
+    Chunks are loaded independently, so they can be streamed to disk a chunk at a time
+    like data loaded with ``dask_chunks``.
+
+    :param list datasets: Datasets to load.
+    :param datacube.utils.geometry.GeoBox geobox: Output grid.
+    :param dict query: Query, the measurements, group_by, fuse_func, resampling and dask_chunks are used.
+    :param PixelCache cache: Pixel cache.
+
+    :return: Data, chunked one time slice by the query's spatial dask chunks (or the whole grid) per chunk.
+    :rtype: xarray.Dataset
+    """
+    product = datasets[0].type
+    measurements = product.lookup_measurements(query.get('measurements') or None)
+    grouped = group_datasets(query, datasets)
+    resampling = query.get('resampling', 'nearest')
+    fuse_func = query.get('fuse_func')
+
+    # Lazily loaded with the same coordinates and attributes dc.load returns, the data is replaced below
+    data = datacube.Datacube.load_data(grouped, geobox, measurements.values(),
+                                       resampling=resampling, fuse_func=fuse_func, dask_chunks={'time': 1})
+
+    # Chunk windows of the output grid, [(row slice, [col slice, ...]), ...]
+    height, width = geobox.shape
+    dask_chunks = query.get('dask_chunks') or {}
+    chunk_rows, chunk_cols = dask_chunks.get('y') or height, dask_chunks.get('x') or width
+    windows = [(slice(row, min(row + chunk_rows, height)),
+                [slice(col, min(col + chunk_cols, width)) for col in range(0, width, chunk_cols)])
+               for row in range(0, height, chunk_rows)]
+
+    for name, measurement in measurements.items():
+        time_slices = []
+        for i in range(len(grouped.time)):
+            sources = grouped.isel(time=slice(i, i + 1))
+            blocks = []
+            for rows, cols_list in windows:
+                blocks.append([])
+                for cols in cols_list:
+                    chunk_box = geobox[rows, cols]
+                    key = cache.key(sources.values[0], name, chunk_box, resampling, fuse_func)
+                    chunk = dask.delayed(_load_chunk)(cache, key, sources, chunk_box, measurement,
+                                                      resampling, fuse_func)
+                    blocks[-1].append(da.from_delayed(chunk, chunk_box.shape, measurement['dtype']))
+            time_slices.append(da.block(blocks))
+        if time_slices:
+            data[name] = data[name].copy(data=da.stack(time_slices))
+
+    return data
+
+
+def _load_chunk(cache, key, sources, geobox, measurement, resampling, fuse_func):
+    data = cache.get(key)
+    if data is None:
+        data = datacube.Datacube.load_data(sources, geobox, [measurement],
+                                           resampling=resampling, fuse_func=fuse_func)
+        data = data[measurement['name']].values[0]
+        cache.put(key, data)
+    return data
+
+
 def measurement_desc(measurement, aliases, brackets=False):
     """
     Generate measurement descriptions from measurement name and aliases.
@@ -263,40 +1083,309 @@ def measurement_desc(measurement, aliases, brackets=False):
         return '/'.join([measurement]+aliases)  # Assumes a list...
 
 
-def run_query(query, config=None, max_datasets=None):
+def _overlaps(dataset, geobox):
+    """ Does a dataset's footprint overlap a geobox, datasets with no footprint are assumed to """
+    extent = dataset.extent
+    if extent is None:
+        return True
+    return extent.to_crs(geobox.crs).intersects(geobox.extent)
+
+
+def parse_expression(expression):
+    """
+    Parse a band math expression.
+
+    Expressions must use at least one measurement name or alias, and may use numbers, ``+ - * / **``,
+    brackets and the functions ``abs``, ``sqrt``, ``exp``, ``log`` (one argument each), ``min`` and ``max``
+    (two arguments each). Nothing else is allowed, so an expression can't run arbitrary code.
+
+    :param str expression: Expression, e.g. ``(nir - red) / (nir + red)``.
+
+    :return: Tuple of the parsed expression and the measurement names or aliases it uses.
+    :rtype: tuple(ast.Expression, set[str])
+
+    :raise ValueError: Invalid expression
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as err:
+        raise ValueError('Invalid expression: {}'.format(err.msg))
+
+    functions = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in _EXPRESSION_FUNCTIONS or node.keywords:
+                raise ValueError('Unsupported function in expression: {}'.format(expression))
+            nargs = _EXPRESSION_FUNCTIONS[node.func.id][1]
+            if len(node.args) != nargs:
+                raise ValueError('{}() takes {} argument{} but {} given in expression: {}'.format(
+                    node.func.id, nargs, '' if nargs == 1 else 's', len(node.args), expression))
+        elif isinstance(node, ast.Name):
+            if id(node) in functions:
+                continue
+            if node.id in _EXPRESSION_FUNCTIONS:
+                raise ValueError('Function used without calling it in expression: {}'.format(node.id))
+            names.add(node.id)
+        elif isinstance(node, (ast.BinOp, ast.UnaryOp)):
+            if type(node.op) not in _EXPRESSION_OPERATORS:
+                raise ValueError('Unsupported operator in expression: {}'.format(type(node.op).__name__))
+        elif _expression_number(node) is None and not isinstance(
+                node, (ast.Expression, ast.Load) + tuple(_EXPRESSION_OPERATORS)):
+            raise ValueError('Unsupported syntax in expression: {}'.format(expression))
+
+    if not names:
+        raise ValueError('Expression must use at least one measurement: {}'.format(expression))
+
+    return tree, names
+
+
+def ping_datacube(dc):
+    """
+    Check a Datacube instance can still reach its index database.
+
+    :param datacube.Datacube dc: Datacube instance.
+
+    :return: False if the connection is unusable.
+    :rtype: bool
+    """
+    try:
+        dc.index.products.get_by_name(_PING_PRODUCT)
+    except sqlalchemy.exc.SQLAlchemyError:
+        return False
+
+    return True
+
+
+def query_geobox(query, datasets):
+    """
+    Get the output grid a query will be loaded on to, without loading it.
+
+    :param dict query: Query, with either a ``like`` geobox or the parameters to build one from.
+    :param list datasets: Datasets found for the query.
+
+    :rtype: datacube.utils.geometry.GeoBox
+    """
+    if query.get('like') is not None:
+        return query['like']
+
+    spatial_query = {k: query[k] for k in ('x', 'y', 'crs') if k in query}
+    return datacube.api.core.output_geobox(output_crs=query.get('output_crs'),
+                                           resolution=query.get('resolution'),
+                                           align=query.get('align'),
+                                           grid_spec=datasets[0].type.grid_spec,
+                                           datasets=datasets,
+                                           **spatial_query)
+
+
+def run_query(query, config=None, max_datasets=None, max_bytes=None, concurrency=1, feedback=None):
     """
     Load and return the data.
 
     :param dict query: Query.
     :param str config: Datacube config filepath or None.
+    :param int max_datasets: Maximum number of datasets to load or None.
+    :param int max_bytes: Maximum estimated peak memory in bytes
+        (see :func:`estimate_query`) or None.
+    :param int concurrency: Number of time slices that will be in memory at once.
+    :param feedback: Optional object with a ``pushInfo(str)`` method the size estimate is reported to,
+        e.g. a :class:`qgis.core.QgsProcessingFeedback`.
 
     :return: Data.
     :rtype: xarray.Dataset
 
     :raise NoDataError: No data found for query
+    :raise TooManyDatasetsError: More than max_datasets found for query
+    :raise TooMuchDataError: Estimated peak memory exceeds max_bytes
 
     """
+    tiles = run_tiled_query(query, config, max_datasets=max_datasets, max_bytes=max_bytes,
+                            concurrency=concurrency, feedback=feedback, tile=False)
+    return tiles[0][1]
 
-    # noinspection PyTypeChecker
-    dc = datacube.Datacube(config=config, app='QGIS Plugin')
 
+def run_tiled_query(query, config=None, max_datasets=None, max_bytes=None, concurrency=1, feedback=None,
+                    tile=True, tile_align=(256, 256), cache=None, datasets=None, expression=None, composite=None):
+    """
+    Load the data, split into spatial tiles if it won't fit in the memory budget.
+
+    If the estimated peak memory exceeds ``max_bytes`` the output grid is split into tiles
+    (see :func:`tile_geobox`) small enough to fit, and each tile is loaded lazily from
+    only the datasets that overlap it.
+
+    :param dict query: Query.
+    :param str config: Datacube config filepath or None.
+    :param int max_datasets: Maximum number of datasets to load or None.
+    :param int max_bytes: Maximum estimated peak memory in bytes
+        (see :func:`estimate_query`) or None.
+    :param int concurrency: Number of time slices that will be in memory at once.
+    :param feedback: Optional object with a ``pushInfo(str)`` method the size estimate is reported to,
+        e.g. a :class:`qgis.core.QgsProcessingFeedback`.
+    :param bool tile: Split the query into tiles if it won't fit in ``max_bytes``,
+        otherwise raise :class:`TooMuchDataError`.
+    :param tuple(int, int) tile_align: Tile (rows, cols) are multiples of this,
+        e.g. the dask chunk or GeoTIFF block size.
+    :param PixelCache cache: Pixel cache to read from and add to, or None to always read source data.
+    :param list datasets: Datasets to load, e.g. from :func:`search_datasets`, or None to search for them.
+    :param str expression: Band math expression the output will be calculated with, or None.
+        Only used to estimate the output size, the loaded data is unchanged.
+    :param str composite: Temporal composite method the output will be reduced with, or None.
+        Only used to estimate the output size, the loaded data is unchanged.
+
+    :return: List of ((row, col), data) tiles in row major order,
+        or [(None, data)] if the query wasn't split.
+    :rtype: list[tuple(Union(tuple(int, int), None), xarray.Dataset)]
+
+    :raise NoDataError: No data found for query
+    :raise TooManyDatasetsError: More than max_datasets found for query
+    :raise TooMuchDataError: Estimated peak memory exceeds max_bytes and ``tile`` is False
+
+    """
+
+    if datasets is None:
+        datasets = search_datasets(query, config, max_datasets)
+
+    tile_shape = None
+    if max_bytes or feedback is not None:
+        estimate = estimate_query(query, datasets, concurrency, expression=expression, composite=composite)
+
+        if feedback is not None:
+            msg = ('Estimated size of {}: {} time steps of {} x {} pixels, '
+                   '{} in memory ({} at once) and {} of output before compression')
+            feedback.pushInfo(msg.format(
+                query['product'], estimate['timesteps'], estimate['width'], estimate['height'],
+                format_bytes(estimate['bytes_in_memory']), format_bytes(estimate['peak_bytes']),
+                format_bytes(estimate['output_bytes'])))
+
+        if max_bytes and estimate['peak_bytes'] > max_bytes:
+            if not tile:
+                msg = ('Estimated memory required ({}) exceeds the memory budget ({}).\n'
+                       'Reduce your spatial extent, or increase the memory budget in Settings.')
+                raise TooMuchDataError(msg.format(format_bytes(estimate['peak_bytes']), format_bytes(max_bytes)))
+            tile_shape = estimate_tile_shape(estimate, max_bytes, tile_align)
+
+    # The datasets already found are loaded rather than searching the index again,
+    # so the data loaded is from exactly the datasets checked and estimated above
+    # Data is loaded lazily, so this is the time to plan the load, the pixels are read while they're written
+    if tile_shape is None:
+        with timed('load') as counters, checkout_datacube(config=config) as dc:
+            if cache is None:
+                data = dc.load(datasets=datasets, **query)
+            else:
+                data = load_cached(datasets, query_geobox(query, datasets), query, cache)
+            counters['bytes_planned'] = data.nbytes  # Size of the lazy arrays, not I/O
+
+        if not data.variables:
+            raise NoDataError('No data found for query:\n{}'.format(str(query)))
+
+        return [(None, data)]
+
+    # The tiles are loaded on to the query's output grid, so drop the parameters it was built from
+    geobox = query_geobox(query, datasets)
+    tile_query = {k: v for k, v in query.items() if k not in SPATIAL_QUERY_KEYS}
+
+    tiles = []
+    for index, tile_box in tile_geobox(geobox, tile_shape):
+        tile_datasets = [ds for ds in datasets if _overlaps(ds, tile_box)]
+        if not tile_datasets:
+            continue
+        with timed('load') as counters, checkout_datacube(config=config) as dc:
+            if cache is None:
+                data = dc.load(datasets=tile_datasets, like=tile_box, **tile_query)
+            else:
+                data = load_cached(tile_datasets, tile_box, tile_query, cache)
+            counters['bytes_planned'] = data.nbytes  # Size of the lazy arrays, not I/O
+        if data.variables:
+            tiles.append((index, data))
+
+    if not tiles:
+        raise NoDataError('No data found for query:\n{}'.format(str(query)))
+
+    if feedback is not None:
+        feedback.pushInfo('Splitting {} into {} tiles of up to {} x {} pixels'.format(
+            query['product'], len(tiles), tile_shape[1], tile_shape[0]))
+
+    return tiles
+
+
+def scale_query(query, datasets, factor):
+    """
+    Get a query for the same extent as another, at ``factor`` times the pixel size.
+
+    Reading the source data at a coarse resolution lets GDAL use any overviews it has,
+    so it's much faster than a full resolution load, e.g. for a quick preview.
+
+    :param dict query: Query.
+    :param list datasets: Datasets found for the query.
+    :param int factor: Pixel size multiplier.
+
+    :return: Query with a ``like`` geobox instead of the spatial parameters.
+    :rtype: dict
+    """
+    geobox = query_geobox(query, datasets)
+    height, width = geobox.shape
+    a, b, c, d, e, f = tuple(geobox.affine)[:6]
+
+    scaled = datacube.utils.geometry.GeoBox(
+        max(math.ceil(width / factor), 1), max(math.ceil(height / factor), 1),
+        affine.Affine(a * factor, b, c, d, e * factor, f), geobox.crs)
+
+    query = {k: v for k, v in query.items() if k not in SPATIAL_QUERY_KEYS}
+    query['like'] = scaled
+    return query
+
+
+def search_datasets(query, config=None, max_datasets=None):
+    """
+    Search the index for the datasets a query will load.
+
+    :param dict query: Query.
+    :param str config: Datacube config filepath or None.
+    :param int max_datasets: Maximum number of datasets to load or None.
+
+    :return: Datasets.
+    :rtype: list[datacube.model.Dataset]
+
+    :raise NoDataError: No datasets found for query
+    :raise TooManyDatasetsError: More than max_datasets found for query
+    """
     test_query = {k: query[k] for k in ('product', 'time', 'x', 'y', 'crs') if k in query}
-    test_query = Query(**test_query)
-    datasets = dc.index.datasets.search_eager(**test_query.search_terms)
+    test_query = datacube.api.query.Query(**test_query)
+
+    with timed('search_datasets') as counters, checkout_datacube(config=config) as dc:
+        # Count first so a query over the limit is refused without fetching every dataset's metadata document
+        if max_datasets:
+            ndatasets = dc.index.datasets.count(**test_query.search_terms)
+            if ndatasets > max_datasets:
+                msg = ('Number of datasets found ({}) exceeds maximum allowed ({}).\n'
+                       'Reduce your temporal or spatial extent, or increase the maximum in Settings.')
+                raise TooManyDatasetsError(msg.format(ndatasets, max_datasets))
+            if not ndatasets:  # Nothing to fetch
+                raise NoDataError('No datasets found for query:\n{}'.format(str(query)))
+
+        datasets = dc.index.datasets.search_eager(**test_query.search_terms)
+        counters['datasets'] = len(datasets)
 
     if not datasets:
         raise NoDataError('No datasets found for query:\n{}'.format(str(query)))
-    elif max_datasets and len(datasets) > max_datasets:
-        msg = ('Number of datasets found ({}) exceeds maximum allowed ({}).\n'
-               'Reduce your temporal or spatial extent, or increase the maximum in Settings.')
-        raise TooManyDatasetsError(msg.format(len(datasets), max_datasets))
 
-    data = dc.load(**query)
+    return datasets
 
-    if not data.variables:
-        raise NoDataError('No data found for query:\n{}'.format(str(query)))
 
-    return data
+def tile_geobox(geobox, tile_shape):
+    """
+    Split a geobox into tiles on the same pixel grid.
+
+    :param datacube.utils.geometry.GeoBox geobox: Output grid.
+    :param tuple(int, int) tile_shape: Tile (rows, cols), tiles on the right and bottom edges may be smaller.
+
+    :return: Iterator over ((row, col), geobox) tiles in row major order.
+    """
+    height, width = geobox.shape
+    tile_rows, tile_cols = tile_shape
+    for row, y in enumerate(range(0, height, tile_rows)):
+        for col, x in enumerate(range(0, width, tile_cols)):
+            yield (row, col), geobox[y:min(y + tile_rows, height), x:min(x + tile_cols, width)]
 
 
 def upcast(dataset, old_dtype):
@@ -337,21 +1426,89 @@ def update_tags(filename, bidx=0, ns=None, **tags):
     :param str ns: Namespace
     :param dict tags: tags to update
     """
-    with rio.open(filename, 'r+') as raster:
+    with timed('update_tags'), rio.open(filename, 'r+') as raster:
         raster.update_tags(bidx=bidx, ns=ns, **tags)
 
 
-def write_geotiff(dataset, filename, time_index=None, profile_override=None, overwrite=False):
+def validate_raster(filename):
+    """
+    Check a raster was completely written, e.g. before reusing an output from an interrupted run.
+
+    GeoTIFFs must have every block of every band written within the file, and VRTs must have
+    all their sources and each source GeoTIFF must be valid.
+
+    :param Union(str, Path) filename: Raster filename.
+
+    :return: True if the raster is complete.
+    :rtype: bool
+    """
+    filepath = Path(filename)
+    try:
+        with rio.open(str(filepath)) as src:
+            files = [Path(f) for f in src.files]
+            if not all(f.exists() for f in files):
+                return False
+
+            if src.driver == 'VRT':
+                sources = [f for f in files if f.suffix.lower() in ('.tif', '.tiff')]
+                return all(validate_raster(f) for f in sources)
+
+            if src.driver != 'GTiff':
+                return True
+
+            filesize = filepath.stat().st_size
+            for bidx, (block_rows, block_cols) in zip(src.indexes, src.block_shapes):
+                for row in range(math.ceil(src.height / block_rows)):
+                    for col in range(math.ceil(src.width / block_cols)):
+                        offset = src.get_tag_item('BLOCK_OFFSET_{}_{}'.format(col, row), 'TIFF', bidx=bidx)
+                        size = src.get_tag_item('BLOCK_SIZE_{}_{}'.format(col, row), 'TIFF', bidx=bidx)
+                        if not offset or not size or int(offset) + int(size) > filesize:
+                            return False
+    except (rio.errors.RasterioError, OSError, ValueError):
+        return False
+
+    return True
+
+
+def write_blocks(raster, bidx, data, chunks=None, statistics=None):
+    """
+    Write an array to a raster band.
+
+    Dask arrays are streamed, each chunk is computed and written to its window
+    as soon as it's ready so only a few chunks are held in memory at once.
+
+    :param rasterio.io.DatasetWriter raster: Raster opened for writing.
+    :param int bidx: Index of band to write.
+    :param data: 2D array to write.
+    :type data: Union(numpy.ndarray, dask.array.Array)
+    :param tuple chunks: (rows, cols) to rechunk dask arrays to, should be multiples
+        of the raster block size so each chunk is written as whole blocks.
+    :param statistics: Optional accumulator updated with each chunk as it's written.
+    """
+    writer = _BandWriter(raster, bidx, statistics)
+    if isinstance(data, da.Array):
+        if chunks is not None:
+            data = data.rechunk(chunks)
+        da.store(data, writer, lock=True)
+    else:
+        writer[tuple(slice(0, n) for n in data.shape)] = data
+
+
+def write_geotiff(dataset, filename, time_index=None, profile_override=None, overwrite=False,
+                  tags=None, overview_options=None, statistics=False, cog=False, threads=None, stack=False):
     """
     Write an xarray dataset to a geotiff
         Modified from datacube.helpers.write_geotiff to support:
-            - dask lazy arrays,
+            - dask lazy arrays, streamed to disk in block aligned chunks,
             - arrays with no time dimension
             - Nodata values
             - Small rasters (row or cols < blocksize)
             - Nodata values
             - dtype checks and upcasting
             - existing output checks
+            - metadata tags, overviews and statistics added while the file is open
+            - Cloud Optimized GeoTIFF output
+            - time stacks of a single measurement, one band per date
         https://github.com/opendatacube/datacube-core/blob/develop/datacube/helpers.py
         Original code licensed under the Apache License, Version 2.0 (the "License");
 
@@ -360,7 +1517,19 @@ def write_geotiff(dataset, filename, time_index=None, profile_override=None, ove
     :param int time_index: time index to write to file
     :param dict profile_override: option dict, overrides rasterio file creation options.
     :param bool overwrite: Allow overwriting existing files.
-
+    :param dict tags: Dataset metadata tags to write.
+    :param dict overview_options: Build overviews with these options (see :func:`build_overviews`)
+        or None to not build overviews.
+    :param bool statistics: Calculate exact band statistics from the data as it's written,
+        ignoring each band's nodata value.
+    :param bool cog: Write a Cloud Optimized GeoTIFF, overviews are always stored internally.
+    :param int threads: Number of threads GDAL may use for compression and overviews.
+    :param bool stack: Write every time slice of a dataset with a single variable, one band per date.
+        Each band's description is its date and it's tagged with its TIFFTAG_DATETIME.
+
+    :return: Band statistics if calculated, nested lists of per band stats
+             [[min, max, mean, std], [min, max, mean, std], etc...]
+    :rtype: Union(list[list[float]], None)
     """
 
     filepath = Path(filename)
@@ -372,11 +1541,20 @@ def write_geotiff(dataset, filename, time_index=None, profile_override=None, ove
 
     dtype = get_dtype(dataset)
 
-    if not check_dtype(dtype):  # Check for invalid dtypes
+    if not rio.dtypes.check_dtype(dtype):  # Check for invalid dtypes
         dataset, dtype = upcast(dataset, dtype)
 
-    if time_index is not None:
-        dataset = dataset.isel(time=time_index)
+    if stack:
+        if len(dataset.data_vars) != 1:
+            raise ValueError('Can only write a time stack of a single variable')
+        data = next(iter(dataset.data_vars.values()))
+        bands = [data.isel(time=i) for i in range(data.sizes['time'])]
+        band_dates = [datetime_to_str(t, '%Y-%m-%d %H:%M:%S') for t in data.time.values]
+        band_tags = [{'TIFFTAG_DATETIME': datetime_to_str(t, '%Y:%m:%d %H:%M:%S')} for t in data.time.values]
+    else:
+        if time_index is not None:
+            dataset = dataset.isel(time=time_index)
+        bands = list(dataset.data_vars.values())
 
     profile = lcase_dict(GTIFF_DEFAULTS.copy())  # Sanitise user modifiable values
 
@@ -397,10 +1575,12 @@ def write_geotiff(dataset, filename, time_index=None, profile_override=None, ove
         'height': height,
         'transform': geobox.affine,
         'crs': geobox.crs.crs_str,
-        'count': len(dataset.data_vars),
+        'count': len(bands),
         'nodata': nodata,
         'dtype': str(dtype)
     })
+    if threads is not None and threads > 1:
+        profile['num_threads'] = threads  # Multithreaded compression
     profile.update(profile_override)
 
     # Block size must be smaller than the image size, and for geotiffs must be divisible by 16
@@ -420,10 +1600,68 @@ def write_geotiff(dataset, filename, time_index=None, profile_override=None, ove
         profile.pop('blockxsize', None)
         profile.pop('blockysize', None)
 
-    with rio.Env():
+    if profile.get('tiled', False):
+        chunks = (profile['blockysize'] * DASK_CHUNK_BLOCKS, profile['blockxsize'] * DASK_CHUNK_BLOCKS)
+    else:
+        chunks = None
+
+    if overview_options is not None:
+        ovr_options = GTIFF_OVR_DEFAULTS.copy()
+        ovr_options.update(overview_options)
+    else:
+        ovr_options = None
+
+    if cog:
+        # Write an uncompressed GeoTIFF with internal overviews to a temporary file then copy it
+        # with COPY_SRC_OVERVIEWS, which writes the overviews before the full resolution data
+        cog_options = {k: v for k, v in profile.items() if k not in COG_EXCLUDE_OPTIONS}
+        cog_options['copy_src_overviews'] = True
+        for k in ('compress', 'predictor', 'jpeg_quality'):
+            profile.pop(k, None)
+        if ovr_options is not None:
+            ovr_options['internal_storage'] = True
+        output_filename = filename
+        filename = filepath.with_name('{}.tmp{}'.format(filepath.stem, filepath.suffix))
+
+    band_stats = []
+
+    with timed('write_geotiff') as counters, rio.Env(**gdal_env(threads)):
         with rio.open(str(filename), 'w', sharing=False, **profile) as dest:
-            if hasattr(dataset, 'data_vars'):
-                for bandnum, data in enumerate(dataset.data_vars.values(), start=1):
-                    if hasattr(data, 'compute'):
-                        data = data.compute()
-                    dest.write(data.values, bandnum)
+            # Reading, computing and compressing the pixels all happen here as the dask chunks are written
+            with timed('write_pixels') as pixel_counters:
+                for bandnum, data in enumerate(bands, start=1):
+                    band_stats.append(_BandStatistics(get_nodata(data)) if statistics else None)
+                    write_blocks(dest, bandnum, data.data, chunks, band_stats[-1])
+                pixel_counters['bytes_in_memory'] = sum(data.nbytes for data in bands)  # Decoded size, not I/O
+
+            if tags:
+                dest.update_tags(**tags)
+
+            if stack:
+                for bandnum, (date, band_tag) in enumerate(zip(band_dates, band_tags), start=1):
+                    dest.set_band_description(bandnum, date)
+                    dest.update_tags(bandnum, **band_tag)
+
+            if statistics:
+                for bandnum, stats in enumerate(band_stats, start=1):
+                    dest.update_tags(bandnum, **stats.tags())
+
+            if ovr_options is not None and ovr_options['internal_storage']:
+                with timed('build_overviews'):
+                    dest.build_overviews(ovr_options['factors'], rio.enums.Resampling[ovr_options['resampling']])
+                    dest.update_tags(ns='rio_overview', resampling=ovr_options['resampling'])
+
+        if ovr_options is not None and not ovr_options['internal_storage']:
+            build_overviews(filename, ovr_options, threads)  # External overviews are built from the closed file
+
+        if cog:
+            try:
+                with timed('copy_cog'):
+                    rio.shutil.copy(str(filename), str(output_filename), driver='GTiff', **cog_options)
+            finally:
+                os.remove(str(filename))
+
+        counters['bytes_written'] = os.path.getsize(str(output_filename if cog else filename))
+
+    if statistics:
+        return [stats.stats() for stats in band_stats]
@@ -8,6 +8,14 @@ from datetime import datetime
 import numpy as np
 
 
+@pytest.fixture(autouse=True)
+def dispose_datacubes():
+    """ Don't leak pooled (mock) Datacube instances between tests """
+    yield
+    from datacube_query.utils import dispose_datacubes
+    dispose_datacubes()
+
+
 @pytest.fixture
 def data_path():
     return Path(Path(__file__).parent, 'data').absolute()
@@ -0,0 +1,101 @@
+from unittest.mock import MagicMock, patch
+
+import tempfile
+
+import datacube_query.catalogue
+
+
+def mock_product(name, definition=None, updated='2001-01-01'):
+    product = MagicMock()
+    product.name = name
+    product.id = sum(map(ord, name))
+    product.updated = updated
+    product.definition = definition if definition is not None else {'name': name}
+    return product
+
+
+def test_catalogue_search_index():
+    items = {
+        'Landsat 8 NBART 25 metre (ls8_nbart_scene)': ['1/band_1/coastal_aerosol', '6/band_6/swir1', '7/band_7/swir2'],
+        'Landsat 8 NBAR 25 metre (ls8_nbar_scene)': ['4/band_4/red', '6/band_6/swir1'],
+        'Landsat 8 PQ 25 metre (ls8_pq_scene)': ['pixelquality'],
+    }
+    index = datacube_query.catalogue.CatalogueSearchIndex(items)
+
+    assert index.search('') is None
+    assert index.search('  ') is None
+    assert index.search('nbart swir') == {'Landsat 8 NBART 25 metre (ls8_nbart_scene)'}
+    assert index.search('NBAR swir') == {'Landsat 8 NBART 25 metre (ls8_nbart_scene)',
+                                         'Landsat 8 NBAR 25 metre (ls8_nbar_scene)'}
+    assert index.search('ls8_pq') == {'Landsat 8 PQ 25 metre (ls8_pq_scene)'}
+    assert index.search('aerosol') == {'Landsat 8 NBART 25 metre (ls8_nbart_scene)'}
+    assert index.search('pq swir') == set()
+    assert index.search('sentinel') == set()
+
+
+@patch('datacube_query.catalogue.checkout_datacube')
+def test_catalogue_fingerprint(mock_checkout_datacube):
+    products = mock_checkout_datacube.return_value.__enter__.return_value.index.products.get_all
+
+    products.return_value = [mock_product('foo'), mock_product('bar')]
+    fingerprint = datacube_query.catalogue.catalogue_fingerprint()
+
+    products.return_value = [mock_product('bar'), mock_product('foo')]
+    assert datacube_query.catalogue.catalogue_fingerprint() == fingerprint
+
+    products.return_value = [mock_product('bar'), mock_product('foo', updated='2001-01-02')]
+    assert datacube_query.catalogue.catalogue_fingerprint() != fingerprint
+
+    products.return_value = [mock_product('foo')]
+    assert datacube_query.catalogue.catalogue_fingerprint() != fingerprint
+
+    # The definition is only used if the index doesn't record when products are updated
+    products.return_value = [mock_product('bar', updated=None), mock_product('foo', updated=None)]
+    fingerprint = datacube_query.catalogue.catalogue_fingerprint()
+    products.return_value = [mock_product('bar', updated=None),
+                             mock_product('foo', {'name': 'foo', 'changed': True}, updated=None)]
+    assert datacube_query.catalogue.catalogue_fingerprint() != fingerprint
+
+
+@patch('datacube_query.catalogue.catalogue_fingerprint')
+@patch('datacube_query.catalogue.get_products_and_measurements')
+def test_get_catalogue(mock_get_products, mock_fingerprint):
+    products = {'Some Dataset (some_dataset)': {
+        'product': 'some_dataset',
+        'measurements': {'some_data': 'some_data'}}}
+    mock_get_products.return_value = products
+    mock_fingerprint.return_value = 'abc'
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        # Cache miss
+        assert datacube_query.catalogue.get_catalogue('foo.conf', tempdir) == products
+        assert mock_get_products.call_count == 1
+        assert datacube_query.catalogue.catalogue_cache_file(tempdir, 'foo.conf').exists()
+
+        # Fresh cache, index not touched
+        assert datacube_query.catalogue.get_catalogue('foo.conf', tempdir) == products
+        assert mock_get_products.call_count == 1
+        assert mock_fingerprint.call_count == 1
+
+        # Stale cache, unchanged index
+        assert datacube_query.catalogue.get_catalogue('foo.conf', tempdir, ttl=0) == products
+        assert mock_get_products.call_count == 1
+        assert mock_fingerprint.call_count == 2
+
+        # Stale cache, changed index
+        mock_fingerprint.return_value = 'def'
+        assert datacube_query.catalogue.get_catalogue('foo.conf', tempdir, ttl=0) == products
+        assert mock_get_products.call_count == 2
+
+        # Cache keyed by config
+        assert datacube_query.catalogue.get_catalogue('bar.conf', tempdir) == products
+        assert mock_get_products.call_count == 3
+
+        # Unreadable cache treated as a miss
+        datacube_query.catalogue.catalogue_cache_file(tempdir, 'foo.conf').write_text('{')
+        assert datacube_query.catalogue.get_catalogue('foo.conf', tempdir) == products
+        assert mock_get_products.call_count == 4
+
+    # No caching
+    assert datacube_query.catalogue.get_catalogue('foo.conf') == products
+    assert mock_get_products.call_count == 5
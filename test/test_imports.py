@@ -0,0 +1,38 @@
+import json
+from pathlib import Path
+import subprocess
+import sys
+
+# Libraries that take seconds to import, they're deferred until a query is run
+HEAVY_MODULES = ('affine', 'dask', 'datacube', 'numpy', 'osgeo', 'pandas', 'rasterio', 'sqlalchemy', 'xarray')
+IMPORT_TIME_BUDGET = 0.5  # seconds to import the plugin
+
+# QGIS and the processing framework are already imported when QGIS loads the plugin,
+# so only what the plugin imports itself is timed
+SCRIPT = '''
+import json
+import sys
+import time
+
+import qgis.core
+import processing
+
+before = set(sys.modules)
+start = time.perf_counter()
+import datacube_query.plugin
+import datacube_query.ui.widgets
+elapsed = time.perf_counter() - start
+
+imported = {{name.split('.')[0] for name in set(sys.modules) - before}}
+print(json.dumps({{'elapsed': elapsed, 'heavy': sorted(imported.intersection({heavy}))}}))
+'''
+
+
+def test_import_time():
+    output = subprocess.run(
+        [sys.executable, '-c', SCRIPT.format(heavy=repr(HEAVY_MODULES))],
+        cwd=str(Path(__file__).parent.parent), stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    result = json.loads(output.splitlines()[-1])
+
+    assert result['heavy'] == []
+    assert result['elapsed'] < IMPORT_TIME_BUDGET
@@ -0,0 +1,74 @@
+from unittest.mock import MagicMock
+
+from pathlib import Path
+import tempfile
+
+import datacube_query.manifest
+
+
+def mock_dataset(id, updated='2001-01-01'):
+    return MagicMock(id=id, updated=updated)
+
+
+def fuser(dest, src):
+    pass
+
+
+def test_manifest_entry():
+    query = {'product': 'tma', 'measurements': ['red', 'green'], 'x': (1, 2), 'y': (3, 4), 'crs': 'EPSG:4283',
+             'time': ['2001-01-01', '2001-12-31'], 'dask_chunks': {'time': 1}, 'fuse_func': fuser}
+    write_options = {'profile_override': {'compress': 'lzw'}, 'statistics': True, 'threads': 1}
+    datasets = [mock_dataset('a'), mock_dataset('b')]
+
+    entry = datacube_query.manifest.manifest_entry(query, write_options, datasets)
+    assert entry['datasets'] == {'a': '2001-01-01', 'b': '2001-01-01'}
+
+    # The time range, chunks and threads don't change the outputs
+    assert entry == datacube_query.manifest.manifest_entry(
+        dict(query, time=['2000-01-01', '2002-12-31'], dask_chunks={'time': 2}),
+        dict(write_options, threads=4), datasets)
+
+    assert entry != datacube_query.manifest.manifest_entry(
+        dict(query, measurements=['green', 'red']), write_options, datasets)
+    assert entry != datacube_query.manifest.manifest_entry(
+        query, dict(write_options, statistics=False), datasets)
+    assert entry != datacube_query.manifest.manifest_entry(
+        query, write_options, [mock_dataset('a'), mock_dataset('b', '2001-02-01')])
+
+
+def test_read_write_manifest():
+    entry = datacube_query.manifest.manifest_entry({'product': 'tma'}, {}, [mock_dataset('a')])
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = datacube_query.manifest.manifest_file(tempdir, 'tma')
+        assert datacube_query.manifest.read_manifest(filepath) == {}
+
+        manifest = {'2001-01-01': dict(entry, path='tma_2001-01-01.tif')}
+        datacube_query.manifest.write_manifest(filepath, manifest)
+        manifest = datacube_query.manifest.read_manifest(filepath)
+        assert [p.name for p in Path(tempdir).iterdir()] == ['tma_manifest.json']
+
+        # Outputs are only up to date if they match the manifest and still exist
+        assert datacube_query.manifest.up_to_date(manifest, '2001-01-01', entry, tempdir) is None
+        Path(tempdir, 'tma_2001-01-01.tif').touch()
+        assert datacube_query.manifest.up_to_date(
+            manifest, '2001-01-01', entry, tempdir) == Path(tempdir, 'tma_2001-01-01.tif')
+        assert datacube_query.manifest.up_to_date(manifest, '2001-01-02', entry, tempdir) is None
+        assert datacube_query.manifest.up_to_date(
+            manifest, '2001-01-01', dict(entry, options='changed'), tempdir) is None
+
+
+def test_read_write_journal():
+    run = datacube_query.manifest.run_fingerprint(products={'tma': ['red']}, write_options={'threads': 1})
+    assert run == datacube_query.manifest.run_fingerprint(products={'tma': ['red']}, write_options={'threads': 4})
+    assert run != datacube_query.manifest.run_fingerprint(products={'tma': ['green']}, write_options={'threads': 1})
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = datacube_query.manifest.journal_file(tempdir)
+        assert datacube_query.manifest.read_journal(filepath) == {}
+
+        datacube_query.manifest.write_journal(filepath, run)
+        assert datacube_query.manifest.read_journal(filepath) == {'run': run, 'finished': False}
+
+        datacube_query.manifest.write_journal(filepath, run, finished=True)
+        assert datacube_query.manifest.read_journal(filepath) == {'run': run, 'finished': True}
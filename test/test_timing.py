@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pathlib import Path
+import tempfile
+
+import datacube_query.timing
+
+
+def write(output):
+    with datacube_query.timing.labelled(product='ls8', output=output):
+        with datacube_query.timing.timed('write_geotiff') as counters:
+            with datacube_query.timing.timed('write_pixels'):
+                pass
+            counters['bytes_written'] = 100
+
+
+def test_timed():
+    # Nothing is recorded unless a registry is recording
+    with datacube_query.timing.timed('search_datasets') as counters:
+        counters['datasets'] = 1
+
+    timings = datacube_query.timing.Timings()
+    with datacube_query.timing.recording(timings):
+        with datacube_query.timing.labelled(product='ls8'):
+            with datacube_query.timing.timed('search_datasets') as counters:
+                counters['datasets'] = 3
+
+        # Labels are set for each thread, functions bound to this thread record to its registry
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(datacube_query.timing.bind(write), ['2001-01-01', '2001-01-02']))
+            list(executor.map(write, ['2001-01-03']))  # Not bound, so not recorded
+
+    with datacube_query.timing.timed('search_datasets'):
+        pass
+
+    assert len(timings.events) == 5
+    assert sorted(timings.values('output', product='ls8')) == ['2001-01-01', '2001-01-02']
+
+    summary = timings.summary(product='ls8')
+    assert list(summary) == ['search_datasets', 'write_pixels', 'write_geotiff']
+    assert summary['search_datasets']['datasets'] == 3
+    assert summary['write_geotiff']['count'] == 2
+    assert summary['write_geotiff']['bytes_written'] == 200
+    assert summary['write_geotiff']['seconds'] >= summary['write_pixels']['seconds']
+    assert 'process_peak_rss' in summary['write_geotiff']  # Whole process, not per stage
+
+    summary = timings.summary(product='ls8', output='2001-01-01')
+    assert summary['write_geotiff']['bytes_written'] == 100
+    assert 'search_datasets' not in summary
+
+
+def record(output):
+    timings = datacube_query.timing.Timings()
+    with datacube_query.timing.recording(timings):
+        write(output)
+    return timings
+
+
+def test_concurrent_recordings():
+    # Runs in different threads record to their own registries
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        recordings = list(executor.map(record, ['2001-01-01', '2001-01-02']))
+
+    assert [timings.values('output') for timings in recordings] == [['2001-01-01'], ['2001-01-02']]
+    assert all(len(timings.events) == 2 for timings in recordings)
+
+
+def test_write_trace():
+    timings = datacube_query.timing.Timings()
+    with datacube_query.timing.recording(timings):
+        write('2001-01-01')
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = datacube_query.timing.trace_file(tempdir)
+        timings.write_trace(filepath)
+        assert filepath == Path(tempdir, 'datacube_trace.json')
+
+        with open(str(filepath)) as f:
+            trace = json.load(f)
+
+    events = {event['name']: event for event in trace['traceEvents']}
+    assert set(events) == {'write_pixels', 'write_geotiff'}
+    assert all(event['ph'] == 'X' for event in events.values())
+    assert events['write_geotiff']['ts'] <= events['write_pixels']['ts']
+    assert events['write_geotiff']['dur'] >= events['write_pixels']['dur']
+    assert events['write_geotiff']['args']['output'] == '2001-01-01'
+    assert events['write_geotiff']['args']['bytes_written'] == 100
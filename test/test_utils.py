@@ -1,11 +1,12 @@
 import pytest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from datetime import datetime
 import tempfile
 import shutil
 from pathlib import Path
 
+import dask.array as da
 import datacube
 import numpy as np
 import pandas as pd
@@ -15,6 +16,153 @@ import xarray as xr
 import datacube_query.utils
 
 
+def test_memory_budget():
+    import threading
+
+    budget = datacube_query.utils.MemoryBudget(100)
+    reserved = threading.Event()
+    released = threading.Event()
+
+    def hold(nbytes):
+        with budget.reserve(nbytes):
+            reserved.set()
+            released.wait(5)
+
+    thread = threading.Thread(target=hold, args=(60,))
+    thread.start()
+    reserved.wait(5)
+    assert budget.available == 40
+
+    with budget.reserve(40):  # Fits alongside
+        assert budget.available == 0
+
+    waiter = threading.Thread(target=hold, args=(1000,))  # Larger than the budget, waits to run alone
+    reserved.clear()
+    waiter.start()
+    assert not reserved.wait(0.1)
+
+    released.set()
+    thread.join(5)
+    waiter.join(5)
+    assert reserved.is_set()
+    assert budget.available == 100
+
+
+def test_pixel_cache():
+    import os
+    from affine import Affine
+    from datacube.utils.geometry import CRS, GeoBox
+
+    geobox = GeoBox(40, 30, Affine(25, 0, 1500000, 0, -25, -3900000), CRS('EPSG:3577'))
+    datasets = [MagicMock(id='b', updated='2001-01-01'), MagicMock(id='a', updated='2001-01-01')]
+
+    key = datacube_query.utils.PixelCache.key(datasets, 'red', geobox, 'nearest')
+    assert key == datacube_query.utils.PixelCache.key(datasets[::-1], 'red', geobox, 'nearest')
+    assert key != datacube_query.utils.PixelCache.key(datasets, 'green', geobox, 'nearest')
+    assert key != datacube_query.utils.PixelCache.key(datasets, 'red', geobox[:10, :10], 'nearest')
+    assert key != datacube_query.utils.PixelCache.key(datasets, 'red', geobox, 'bilinear')
+
+    # Datasets updated in the index are read again
+    updated = [MagicMock(id='b', updated='2001-02-01'), MagicMock(id='a', updated='2001-01-01')]
+    assert key != datacube_query.utils.PixelCache.key(updated, 'red', geobox, 'nearest')
+
+    data = np.arange(30 * 40, dtype=np.int16).reshape(30, 40)
+    with tempfile.TemporaryDirectory() as tempdir:
+        cache = datacube_query.utils.PixelCache(Path(tempdir, 'pixels'), data.nbytes * 2 + 1000)
+        assert cache.get('a') is None
+
+        for i, key in enumerate('abc'):
+            cache.put(key, data + i)
+
+        # Only two entries fit, the least recently used is evicted
+        assert cache.get('a') is None
+        assert np.array_equal(cache.get('b'), data + 1)
+        assert np.array_equal(cache.get('c'), data + 2)
+
+        # Reading an entry marks it as recently used
+        assert np.array_equal(cache.get('b'), data + 1)
+        cache.put('a', data)
+        assert cache.get('c') is None
+        assert sorted(path.stem for path in cache.path.glob('*.npy')) == ['a', 'b']
+
+        # Entries from an earlier session are evicted least recently used first
+        for i, key in enumerate('ba'):
+            os.utime(str(cache.path / '{}.npy'.format(key)), (i, i))
+        cache = datacube_query.utils.PixelCache(cache.path, cache.max_bytes)
+        cache.put('c', data + 2)
+        assert cache.get('b') is None
+        assert np.array_equal(cache.get('a'), data)
+
+        # Threads writing the same entry don't clobber each other's temporary files
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda i: cache.put('d', data), range(8)))
+        assert np.array_equal(cache.get('d'), data)
+        assert not list(cache.path.glob('*.tmp'))
+
+
+def test_band_statistics():
+    data = np.random.RandomState(42).normal(1e6, 10, (100, 100))
+    data[:10, :10] = -999
+    data[-10:, -10:] = np.nan
+    valid = data[(data != -999) & ~np.isnan(data)]
+
+    stats = datacube_query.utils._BandStatistics(nodata=-999)
+    for block in np.array_split(data, 7):
+        stats.update(block)
+
+    assert np.allclose(stats.stats(), [valid.min(), valid.max(), valid.mean(), valid.std()], rtol=1e-12)
+    assert float(stats.tags()['STATISTICS_VALID_PERCENT']) == 98.0
+
+    stats = datacube_query.utils._BandStatistics(nodata=-999)
+    stats.update(np.full((2, 2), -999))
+    assert stats.stats() is None
+    assert stats.tags() == {}
+
+
+def test_bounded_imap():
+    import threading
+    import time
+
+    lock = threading.Lock()
+    running = []
+    in_flight = [0]
+
+    def func(i):
+        with lock:
+            in_flight[0] += 1
+            running.append(in_flight[0])
+        time.sleep(0.01 * (5 - i % 5))  # Finish out of order
+        with lock:
+            in_flight[0] -= 1
+        return i * 2
+
+    assert list(datacube_query.utils.bounded_imap(func, range(10))) == list(range(0, 20, 2))
+    assert max(running) == 1
+
+    running.clear()
+    assert list(datacube_query.utils.bounded_imap(func, range(10), max_workers=3)) == list(range(0, 20, 2))
+    assert max(running) <= 3
+
+    # Items in flight are finished when cancelled
+    started = []
+
+    def func(i):
+        started.append(i)
+        return i
+
+    results = list(datacube_query.utils.bounded_imap(func, range(10), max_workers=2,
+                                                     is_canceled=lambda: len(started) >= 4))
+    assert results == sorted(started)
+    assert len(results) < 10
+
+
+def test_build_dask_chunks():
+    assert datacube_query.utils.build_dask_chunks() == {'time': 1, 'x': 2048, 'y': 2048}
+    assert (datacube_query.utils.build_dask_chunks({'BLOCKXSIZE': 512, 'blockysize': 128}, blocks=2) ==
+            {'time': 1, 'x': 1024, 'y': 256})
+
+
 def test_build_overviews(data_path):
     without_ovr = Path(data_path,'test_without_ovr.tif')
     with_ovr = Path(data_path, 'test_with_ovr.tif')
@@ -43,6 +191,29 @@ def test_build_query():
     assert known_query == test_query
 
 
+def test_build_vrt():
+    from affine import Affine
+
+    data = np.arange(20 * 30, dtype=np.int16).reshape(20, 30)
+    profile = {'driver': 'GTiff', 'height': 20, 'count': 1, 'dtype': 'int16', 'crs': 'EPSG:3577'}
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        tiles = []
+        for x in (0, 16):
+            tiles.append(Path(tempdir, 'tile_{}.tif'.format(x)))
+            window = data[:, x:x + 16]
+            with rio.open(str(tiles[-1]), 'w', width=window.shape[1],
+                          transform=Affine(25, 0, 1500000 + x * 25, 0, -25, -3900000), **profile) as dest:
+                dest.write(window, 1)
+
+        path = Path(tempdir, 'test.vrt')
+        datacube_query.utils.build_vrt(path, tiles, tags={'TIFFTAG_DATETIME': '2001:01:31'})
+
+        with rio.open(str(path)) as src:
+            assert src.tags()['TIFFTAG_DATETIME'] == '2001:01:31'
+            assert np.array_equal(src.read(1), data)
+
+
 def test_calculate_statistics(data_path, shut_gdal_up):
     with pytest.raises(Exception), shut_gdal_up:
         datacube_query.utils.calculate_statistics('foo')
@@ -60,6 +231,95 @@ def test_calculate_statistics(data_path, shut_gdal_up):
         assert np.allclose(got, expected)
 
 
+@patch('datacube.Datacube')
+def test_checkout_datacube(mock_datacube):
+    checkout = datacube_query.utils.checkout_datacube
+
+    def create(*args, **kwargs):
+        assert not datacube_query.utils._datacubes_lock.locked()  # Connecting doesn't block other threads
+        return MagicMock()
+
+    mock_datacube.side_effect = create
+
+    with checkout('foo.conf') as dc:
+        with checkout('foo.conf') as other:
+            assert other is dc
+        with checkout('bar.conf') as other:
+            assert other is not dc
+    assert mock_datacube.call_count == 2
+
+    # Idle instances are closed and replaced, but not while they're checked out
+    with checkout('foo.conf') as dc:
+        with checkout('bar.conf', max_idle=-1):
+            pass
+        assert not dc.close.called
+    with checkout('foo.conf', max_idle=-1) as other:
+        assert other is not dc
+    dc.close.assert_called_once_with()
+
+    # Instances that fail a health check are replaced, the pool isn't locked during the check
+    def ping(_):
+        assert not datacube_query.utils._datacubes_lock.locked()
+        return False
+
+    with checkout('foo.conf') as dc:
+        with patch('datacube_query.utils.ping_datacube', side_effect=ping) as mock_ping:
+            with checkout('foo.conf', ping_after=-1) as other:
+                assert other is not dc
+        mock_ping.assert_called_once_with(dc)
+        assert not dc.close.called  # Closed when it's checked back in
+    dc.close.assert_called_once_with()
+
+    with checkout('foo.conf') as dc:
+        datacube_query.utils.dispose_datacubes()
+        assert not dc.close.called
+    dc.close.assert_called_once_with()
+    with checkout('foo.conf') as other:
+        assert other is not dc
+
+
+def test_composite(fake_data_2x2x2):
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    data.FOO.data[:, 0, 0] = [-1, 3]
+    data.FOO.data[:, 0, 1] = -1  # nodata
+    data.FOO.data[:, 1, 1] = [1, 5]
+
+    for dataset in (data, data.chunk({'time': 1, 'x': 1, 'y': 1})):
+        median = datacube_query.utils.composite(dataset, 'median')
+        assert median.FOO.dims == ('y', 'x')
+        assert median.FOO.dtype == np.float32
+        assert np.isnan(median.FOO.nodata)
+        assert np.array_equal(median.FOO.values, [[3, np.nan], [1, 3]], equal_nan=True)
+
+        minimum = datacube_query.utils.composite(dataset, 'min')
+        assert minimum.FOO.dtype == np.int8
+        assert minimum.FOO.nodata == -1
+        assert np.array_equal(minimum.FOO.values, [[3, -1], [1, 1]])
+
+        maximum = datacube_query.utils.composite(dataset, 'max')
+        assert np.array_equal(maximum.FOO.values, [[3, -1], [1, 5]])
+
+        p75 = datacube_query.utils.composite(dataset, 'percentile', 75)
+        assert p75.FOO.dtype == np.float32
+        assert np.array_equal(p75.FOO.values, [[3, np.nan], [1, 4]], equal_nan=True)
+
+        # Without nodata there's nothing to cast pixels with no valid data to
+        no_nodata = dataset.assign(FOO=dataset.FOO.astype(np.float32).where(dataset.FOO != -1))
+        del no_nodata.FOO.attrs['nodata']
+        minimum = datacube_query.utils.composite(no_nodata, 'min')
+        assert minimum.FOO.dtype == np.float32
+        assert np.isnan(minimum.FOO.nodata)
+        assert np.array_equal(minimum.FOO.values, [[3, np.nan], [1, 1]], equal_nan=True)
+
+        # Every variable has the same dtype, so a variable without nodata makes them all float
+        mixed = dataset.assign(BAR=no_nodata.FOO)
+        minimum = datacube_query.utils.composite(mixed, 'min')
+        assert minimum.FOO.dtype == minimum.BAR.dtype == np.float32
+        assert np.array_equal(minimum.FOO.values, [[3, np.nan], [1, 1]], equal_nan=True)
+
+        assert median.crs == data.crs
+
+
 def test_datetime_to_str():
     # Nanosec res
     dtns = np.datetime64('2001-12-31T01:23:45.000000000')
@@ -100,6 +360,125 @@ def test_datetime_to_str():
         datacube_query.utils.datetime_to_str(xrms)
 
 
+def test_dtype_nodata():
+    # Integers are promoted so nodata is outside the range of the data
+    assert datacube_query.utils.dtype_nodata(np.uint8) == (np.int16, -1)
+    assert datacube_query.utils.dtype_nodata('int16') == (np.int32, -32769)
+    assert datacube_query.utils.dtype_nodata('uint32') == (np.int64, -1)
+
+    dtype, nodata = datacube_query.utils.dtype_nodata('float32')
+    assert dtype == np.float32 and np.isnan(nodata)
+    dtype, nodata = datacube_query.utils.dtype_nodata('uint64')
+    assert dtype == np.float64 and np.isnan(nodata)
+
+
+@patch('datacube.api.core.output_geobox')
+@patch('datacube.Datacube')
+def test_estimate_query(mock_datacube, mock_output_geobox):
+    mock_output_geobox.return_value.shape = (300, 400)
+    mock_datacube.group_datasets.return_value = xr.DataArray(np.arange(4), dims=['time'])
+
+    dataset = MagicMock()
+    dataset.type.lookup_measurements.return_value = {
+        'red': {'dtype': 'int16'}, 'green': {'dtype': 'int16'}, 'fmask': {'dtype': 'uint8'}}
+
+    query = {'product': 'tma', 'measurements': ['red', 'green', 'fmask'],
+             'x': (19680402.0, 19680205.0), 'y': (-19680205.0, -19680402.0),
+             'time': ['2001-01-01', '2001-12-31'], 'crs': 'EPSG:4283', 'group_by': 'solar_day'}
+
+    estimate = datacube_query.utils.estimate_query(query, [dataset] * 6, concurrency=2)
+
+    assert estimate == {
+        'datasets': 6, 'timesteps': 4, 'width': 400, 'height': 300,
+        'pixels': 400 * 300 * 4 * 3,
+        'bytes_in_memory': 400 * 300 * 5 * 4,
+        'timestep_bytes': 400 * 300 * 5,
+        'output_timestep_bytes': 400 * 300 * 5,
+        'output_bytes': 400 * 300 * 5 * 4,
+        'peak_bytes': 400 * 300 * 5 * 2}
+
+    # An expression is one float32 band per time step, calculated alongside the time steps in memory
+    estimate = datacube_query.utils.estimate_query(query, [dataset] * 6, concurrency=2, expression='red + green')
+    assert estimate['output_bytes'] == 400 * 300 * 4 * 4
+    assert estimate['peak_bytes'] == 400 * 300 * (5 + 4) * 2
+
+    # A composite is a single float32 time step of every measurement
+    estimate = datacube_query.utils.estimate_query(query, [dataset] * 6, concurrency=2, composite='median')
+    assert estimate['output_bytes'] == 400 * 300 * 4 * 3
+    assert estimate['peak_bytes'] == 400 * 300 * (5 * 2 + 4 * 3)
+
+    # Min and max composites keep the dtype of measurements with nodata, if they all have the same dtype
+    for measurement in dataset.type.lookup_measurements.return_value.values():
+        measurement['nodata'] = 0
+    estimate = datacube_query.utils.estimate_query(query, [dataset] * 6, concurrency=2, composite='max')
+    assert estimate['output_bytes'] == 400 * 300 * 4 * 3
+
+    del dataset.type.lookup_measurements.return_value['fmask']
+    estimate = datacube_query.utils.estimate_query(query, [dataset] * 6, concurrency=2, composite='max')
+    assert estimate['output_bytes'] == 400 * 300 * 2 * 2
+
+
+def test_estimate_tile_shape():
+    estimate = {'width': 4000, 'height': 3000, 'timestep_bytes': 4000 * 3000 * 2, 'peak_bytes': 4000 * 3000 * 2 * 4}
+
+    # 4 slices of 2 bytes per pixel in 8MB is 1024 x 1024 pixels
+    assert datacube_query.utils.estimate_tile_shape(estimate, 8 * 2**20, (256, 256)) == (1024, 1024)
+    assert datacube_query.utils.estimate_tile_shape(estimate, 9 * 2**20, (256, 512)) == (1024, 1024)
+    assert datacube_query.utils.estimate_tile_shape(estimate, 1, (256, 256)) == (256, 256)
+    assert datacube_query.utils.estimate_tile_shape(estimate, 2**40, (256, 256)) == (3000, 4000)
+
+
+def test_evaluate_expression(fake_data_2x2x2):
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    data['BAR'] = data.FOO.copy(data=np.full((2, 2, 2), 3, dtype=np.int8))
+    data.FOO.data[0, 0, 0] = -1  # nodata
+    data.BAR.data[1, 1, 1] = -1  # nodata in the other input
+
+    for dataset in (data, data.chunk({'time': 1, 'x': 1, 'y': 1})):
+        result = datacube_query.utils.evaluate_expression(dataset, '(BAR - FOO) / (BAR + FOO)', name='ndi')
+        assert list(result.data_vars) == ['ndi']
+        assert result.ndi.dtype == np.float32
+        assert np.isnan(result.ndi.nodata)
+        assert np.array_equal(result.ndi.values, [[[np.nan, 0.5], [0.5, 0.5]], [[0.5, 0.5], [0.5, np.nan]]],
+                              equal_nan=True)
+
+        result = datacube_query.utils.evaluate_expression(dataset, 'sqrt(BAR * 3) + -1')
+        assert np.allclose(result.expression.values[1, 0, 0], 2)
+
+    with pytest.raises(ValueError):
+        datacube_query.utils.evaluate_expression(data, 'FOO + BAZ')
+    with pytest.raises(ValueError):
+        datacube_query.utils.evaluate_expression(data, '1 + 2')
+
+    # Names that aren't measurement names are looked up in the aliases
+    result = datacube_query.utils.evaluate_expression(data, 'nir - FOO', aliases={'nir': 'BAR'})
+    assert np.allclose(result.expression.values[1, 0, 0], 2)
+    with pytest.raises(ValueError):
+        datacube_query.utils.evaluate_expression(data, 'nir - FOO')
+
+
+def test_expression_aliases():
+    measurements = {'1/band_1/coastal_aerosol': '1', '4/band_4/red': '4', '5/band_5/nir': '5', 'fmask': 'fmask'}
+    assert datacube_query.utils.expression_aliases({'red', 'nir', 'fmask', 'blue'}, measurements) == {
+        'red': '4', 'nir': '5', 'fmask': 'fmask'}
+
+    # Measurement names take precedence over aliases
+    assert datacube_query.utils.expression_aliases({'red'}, {'red': 'red', 'b/red': 'b'}) == {'red': 'red'}
+
+
+def test_format_bytes():
+    assert datacube_query.utils.format_bytes(512) == '512 B'
+    assert datacube_query.utils.format_bytes(1536) == '1.5 KB'
+    assert datacube_query.utils.format_bytes(3 * 2**30) == '3.0 GB'
+    assert datacube_query.utils.format_bytes(2**50) == '1024.0 TB'
+
+
+def test_gdal_env():
+    assert 'GDAL_NUM_THREADS' not in datacube_query.utils.gdal_env()
+    assert 'GDAL_NUM_THREADS' not in datacube_query.utils.gdal_env(1)
+    assert datacube_query.utils.gdal_env(4)['GDAL_NUM_THREADS'] == 4
+
+
 @patch('datacube.Datacube')
 def test_get_products_and_measurements(mock_datacube):
     from datacube.utils.geometry import CRS
@@ -168,6 +547,31 @@ def test_measurement_desc():
     assert datacube_query.utils.measurement_desc(measurement, list_aliases, True) == 'abc (def/ghi)'
 
 
+def test_parse_expression():
+    _, names = datacube_query.utils.parse_expression('(nir - red) / (nir + red)')
+    assert names == {'nir', 'red'}
+
+    _, names = datacube_query.utils.parse_expression('max(abs(swir1), 0.5) ** 2')
+    assert names == {'swir1'}
+
+    for expression in ('__import__("os").remove("x")', 'nir.real', 'nir[0]', 'nir % 2', 'sqrt + red',
+                       'red if nir else 0', 'open(red)', '"red"', '(nir - red', '',
+                       'sqrt(red, nir)', 'log()', '2 + 3', 'sqrt(4)', 'max(red)', 'min(red, nir, 0)', 'abs(*red)'):
+        with pytest.raises(ValueError):
+            datacube_query.utils.parse_expression(expression)
+
+
+def test_ping_datacube():
+    from sqlalchemy.exc import OperationalError
+
+    dc = MagicMock()
+    assert datacube_query.utils.ping_datacube(dc)
+    dc.index.products.get_by_name.assert_called_once()
+
+    dc.index.products.get_by_name.side_effect = OperationalError('SELECT', {}, None)
+    assert not datacube_query.utils.ping_datacube(dc)
+
+
 @patch('datacube.Datacube')
 def test_run_query_no_datasets(mock_datacube):
     from datacube_query.exceptions import NoDataError
@@ -198,8 +602,9 @@ def test_run_query_no_data(mock_datacube):
 
 @patch('datacube.Datacube')
 def test_run_query_too_many_datasets(mock_datacube):
-    from datacube_query.exceptions import TooManyDatasetsError
+    from datacube_query.exceptions import NoDataError, TooManyDatasetsError
 
+    mock_datacube().index.datasets.count.return_value = 3
     mock_datacube().index.datasets.search_eager.return_value = [1] * 3
 
     query = {'product': 'tma', 'measurements': ['1', '4', '9'],
@@ -208,6 +613,40 @@ def test_run_query_too_many_datasets(mock_datacube):
 
     with pytest.raises(TooManyDatasetsError):
         datacube_query.utils.run_query(query, max_datasets=2)
+    mock_datacube().index.datasets.search_eager.assert_not_called()  # Refused on the count alone
+
+    datacube_query.utils.run_query(query, max_datasets=3)
+    mock_datacube().index.datasets.search_eager.assert_called_once()
+
+    # No datasets to fetch
+    mock_datacube().index.datasets.count.return_value = 0
+    with pytest.raises(NoDataError):
+        datacube_query.utils.run_query(query, max_datasets=3)
+    mock_datacube().index.datasets.search_eager.assert_called_once()
+
+
+@patch('datacube_query.utils.estimate_query')
+@patch('datacube.Datacube')
+def test_run_query_too_much_data(mock_datacube, mock_estimate_query):
+    from datacube_query.exceptions import TooMuchDataError
+
+    mock_datacube().index.datasets.search_eager.return_value = [1] * 3
+    mock_estimate_query.return_value = {
+        'datasets': 3, 'timesteps': 3, 'width': 400, 'height': 300, 'pixels': 360000,
+        'bytes_in_memory': 720000, 'timestep_bytes': 240000, 'peak_bytes': 240000,
+        'output_timestep_bytes': 240000, 'output_bytes': 720000}
+    feedback = MagicMock()
+
+    query = {'product': 'tma', 'measurements': ['1', '4', '9'],
+             'x': (19680402.0, 19680205.0), 'y': (-19680205.0, -19680402.0),
+             'time': ['2001-01-01', '2001-12-31'], 'crs': 'EPSG:4283'}
+
+    with pytest.raises(TooMuchDataError):
+        datacube_query.utils.run_query(query, max_bytes=200000, feedback=feedback)
+    assert feedback.pushInfo.called
+
+    datacube_query.utils.run_query(query, max_bytes=300000)
+    mock_datacube().load.assert_called_once()
 
 
 @patch('datacube.Datacube')
@@ -223,6 +662,7 @@ def test_run_query_with_data(mock_datacube):
 
     mock_dataset = xr.Dataset({'blue': data_array, 'green': data_array, 'red': data_array})
     mock_datacube().load.return_value = mock_dataset
+    mock_datacube().index.datasets.search_eager.return_value = [1] * 3
 
     query = {'product': 'tma', 'measurements': ['1', '4', '9'],
              'x': (19680402.0, 19680205.0), 'y': (-19680205.0, -19680402.0),
@@ -230,6 +670,9 @@ def test_run_query_with_data(mock_datacube):
 
     assert mock_dataset.identical(datacube_query.utils.run_query(query))
 
+    # The datasets found by the search are loaded, rather than searching again
+    mock_datacube().load.assert_called_once_with(datasets=[1] * 3, **query)
+
 
 @patch('datacube.Datacube')
 def test_run_query_with_dodgy_crs(mock_datacube, shut_gdal_up):
@@ -241,6 +684,77 @@ def test_run_query_with_dodgy_crs(mock_datacube, shut_gdal_up):
         datacube_query.utils.run_query(query)
 
 
+@patch('datacube_query.utils.query_geobox')
+@patch('datacube_query.utils.estimate_query')
+@patch('datacube.Datacube')
+def test_run_tiled_query(mock_datacube, mock_estimate_query, mock_query_geobox):
+    from affine import Affine
+    from datacube.utils.geometry import CRS, GeoBox
+
+    dataset = MagicMock()
+    dataset.extent = None
+    mock_datacube().index.datasets.search_eager.return_value = [dataset] * 3
+    mock_datacube().load.return_value = xr.Dataset({'foo': xr.DataArray([1])})
+    mock_estimate_query.return_value = {
+        'datasets': 3, 'timesteps': 3, 'width': 400, 'height': 300, 'pixels': 360000,
+        'bytes_in_memory': 720000, 'timestep_bytes': 240000, 'peak_bytes': 240000,
+        'output_timestep_bytes': 240000, 'output_bytes': 720000}
+    mock_query_geobox.return_value = GeoBox(400, 300, Affine(25, 0, 1500000, 0, -25, -3900000), CRS('EPSG:3577'))
+
+    query = {'product': 'tma', 'measurements': ['1', '4', '9'],
+             'x': (19680402.0, 19680205.0), 'y': (-19680205.0, -19680402.0),
+             'time': ['2001-01-01', '2001-12-31'], 'crs': 'EPSG:4283', 'output_crs': 'EPSG:3577'}
+
+    tiles = datacube_query.utils.run_tiled_query(query, max_bytes=300000, tile_align=(128, 128))
+    assert [index for index, _ in tiles] == [None]
+
+    mock_datacube().load.reset_mock()
+    tiles = datacube_query.utils.run_tiled_query(query, max_bytes=100000, tile_align=(128, 128))
+    assert [index for index, _ in tiles] == [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2), (2, 0), (2, 1), (2, 2)]
+
+    # Each tile is loaded on to its part of the output grid, from the datasets already found
+    kwargs = mock_datacube().load.call_args_list[-1][1]
+    assert kwargs['like'].shape == (300 - 256, 400 - 256)
+    assert kwargs['datasets'] == [dataset] * 3
+    assert 'x' not in kwargs and 'output_crs' not in kwargs
+
+
+@patch('datacube.api.core.output_geobox')
+def test_scale_query(mock_output_geobox):
+    from affine import Affine
+    from datacube.utils.geometry import CRS, GeoBox
+
+    mock_output_geobox.return_value = GeoBox(250, 100, Affine(25, 0, 1500000, 0, -25, -3900000), CRS('EPSG:3577'))
+    dataset = MagicMock()
+
+    query = {'product': 'tma', 'measurements': ['1', '4', '9'],
+             'x': (19680402.0, 19680205.0), 'y': (-19680205.0, -19680402.0),
+             'time': ['2001-01-01', '2001-12-31'], 'crs': 'EPSG:4283', 'output_crs': 'EPSG:3577', 'resolution': 25}
+
+    scaled = datacube_query.utils.scale_query(query, [dataset], 16)
+
+    assert scaled['like'].shape == (7, 16)
+    assert scaled['like'].affine == Affine(400, 0, 1500000, 0, -400, -3900000)
+    assert scaled['like'].crs == CRS('EPSG:3577')
+    assert {k: v for k, v in scaled.items() if k != 'like'} == {
+        'product': 'tma', 'measurements': ['1', '4', '9'], 'time': ['2001-01-01', '2001-12-31']}
+
+    # The scaled geobox is used as is
+    assert datacube_query.utils.query_geobox(scaled, [dataset]) is scaled['like']
+
+
+def test_tile_geobox():
+    from affine import Affine
+    from datacube.utils.geometry import CRS, GeoBox
+
+    geobox = GeoBox(250, 100, Affine(25, 0, 1500000, 0, -25, -3900000), CRS('EPSG:3577'))
+    tiles = list(datacube_query.utils.tile_geobox(geobox, (64, 128)))
+
+    assert [index for index, _ in tiles] == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert [tile.shape for _, tile in tiles] == [(64, 128), (64, 122), (36, 128), (36, 122)]
+    assert tiles[3][1].affine == Affine(25, 0, 1500000 + 128 * 25, 0, -25, -3900000 - 64 * 25)
+
+
 def test_upcast(fake_data_2x2x2):
 
     data = xr.Dataset.from_dict(fake_data_2x2x2)
@@ -266,3 +780,114 @@ def test_write_geotiff(fake_data_2x2x2):
         assert path.exists()
 
 
+def test_validate_raster(fake_data_2x2x2):
+    import os
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        datacube_query.utils.write_geotiff(data, path, time_index=0)
+        assert datacube_query.utils.validate_raster(path)
+
+        vrt = Path(tempdir, 'test.vrt')
+        datacube_query.utils.build_vrt(vrt, [path])
+        assert datacube_query.utils.validate_raster(vrt)
+
+        # Truncated, e.g. by a crash while writing
+        with open(str(path), 'r+b') as f:
+            f.truncate(os.path.getsize(str(path)) - 1)
+        assert not datacube_query.utils.validate_raster(path)
+        assert not datacube_query.utils.validate_raster(vrt)
+
+        path.unlink()
+        assert not datacube_query.utils.validate_raster(path)
+        assert not datacube_query.utils.validate_raster(vrt)
+
+
+def test_write_blocks():
+    data = np.arange(100 * 120, dtype=np.int16).reshape(100, 120)
+    profile = {'driver': 'GTiff', 'width': 120, 'height': 100, 'count': 2, 'dtype': 'int16',
+               'tiled': True, 'blockxsize': 32, 'blockysize': 32}
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = str(Path(tempdir, 'test.tif'))
+        with rio.open(path, 'w', **profile) as dest:
+            datacube_query.utils.write_blocks(dest, 1, data)
+            datacube_query.utils.write_blocks(dest, 2, da.from_array(data, chunks=(25, 50)), chunks=(64, 64))
+
+        with rio.open(path) as src:
+            assert np.array_equal(src.read(1), data)
+            assert np.array_equal(src.read(2), data)
+
+
+def test_write_geotiff_dask(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2).chunk({'time': 1, 'x': 1, 'y': 1})
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        datacube_query.utils.write_geotiff(data, path, time_index=1, threads=2)
+
+        with rio.open(str(path)) as src:
+            assert np.array_equal(src.read(1), data.FOO.isel(time=1).values)
+
+
+def test_write_geotiff_single_pass(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    data.FOO.data[1, 0, 0] = -1  # nodata
+    data.FOO.data[1, 1, 1] = 3
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        stats = datacube_query.utils.write_geotiff(
+            data, path, time_index=1,
+            tags={'TIFFTAG_DATETIME': '2001:12:30'},
+            overview_options={'factors': [2]},
+            statistics=True)
+
+        assert np.allclose(stats, [[1, 3, 5 / 3, np.std([1, 1, 3])]])
+
+        with rio.open(str(path)) as src:
+            assert src.tags()['TIFFTAG_DATETIME'] == '2001:12:30'
+            assert np.allclose([float(src.tags(1)[k]) for k in (
+                'STATISTICS_MINIMUM', 'STATISTICS_MAXIMUM', 'STATISTICS_MEAN', 'STATISTICS_STDDEV')], stats[0])
+            assert src.tags(ns='rio_overview') == {'resampling': 'average'}
+
+
+def test_write_geotiff_stack(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    data.FOO.data[1] = 2
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        stats = datacube_query.utils.write_geotiff(data, path, statistics=True, stack=True)
+        assert len(stats) == 2
+
+        vrt = Path(tempdir, 'test.vrt')
+        datacube_query.utils.build_vrt(vrt, [path])
+
+        for filepath in (path, vrt):
+            with rio.open(str(filepath)) as src:
+                assert src.count == 2
+                assert src.descriptions == ('2001-01-31 23:59:59', '2001-12-30 23:59:59')
+                assert src.tags(2)['TIFFTAG_DATETIME'] == '2001:12:30 23:59:59'
+                assert np.array_equal(src.read(), data.FOO.values)
+
+        with pytest.raises(ValueError):
+            datacube_query.utils.write_geotiff(data.assign(BAR=data.FOO), path, overwrite=True, stack=True)
+
+
+def test_write_geotiff_cog(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        datacube_query.utils.write_geotiff(
+            data, path, time_index=0, overview_options={'factors': [2], 'internal_storage': False},
+            tags={'TIFFTAG_DATETIME': '2001:01:31'}, statistics=True, cog=True)
+
+        assert [p.name for p in Path(tempdir).iterdir()] == ['test.tif']  # No external overviews or temp file
+        with rio.open(str(path)) as src:
+            assert src.overviews(1) == [2]
+            assert src.tags()['TIFFTAG_DATETIME'] == '2001:01:31'
+            assert 'STATISTICS_MEAN' in src.tags(1)
+            assert np.array_equal(src.read(1), data.FOO.isel(time=0).values)
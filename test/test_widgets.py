@@ -84,3 +84,107 @@ def test_products():
 
     assert json.loads(w.value()) == test_selected
     app.exit(0)
+
+
+def test_products_loading():
+
+    app = QgsApplication([], False)
+    from qgis.PyQt.QtCore import QObject, pyqtSignal
+    from datacube_query.ui import widgets
+
+    test_data = OrderedDict([
+        ['ls7_nbar_albers', ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']],
+        ['ls8_nbar_albers', ['coastal_aerosol', 'blue', 'green', 'red', 'nir', 'swir1', 'swir2']]])
+
+    class Catalogue(QObject):
+        loaded = pyqtSignal()
+        loading = True
+
+        def items(self):
+            return test_data
+
+    catalogue = Catalogue()
+    w = widgets.WidgetProducts(None, catalogue)
+
+    test_selected = OrderedDict([
+        ['ls7_nbar_albers', ['green']],
+        ['ls8_nbar_albers', ['blue', 'green', 'red']]])
+
+    # Selections made before the products are loaded are kept
+    w.set_value(test_selected)
+    assert json.loads(w.value()) == test_selected
+
+    catalogue.loading = False
+    catalogue.loaded.emit()
+
+    assert json.loads(w.value()) == test_selected
+    model = w.tree_products.model()
+    assert [model.index(row, 0).data() for row in range(model.rowCount())] == list(test_data)
+    app.exit(0)
+
+
+def test_products_filter():
+
+    app = QgsApplication([], False)
+    from datacube_query.ui import widgets
+
+    test_data = OrderedDict([
+        ['Landsat 8 NBART 25 metre (ls8_nbart_scene)', ['1/band_1/coastal_aerosol', '6/band_6/swir1']],
+        ['Landsat 8 NBAR 25 metre (ls8_nbar_scene)', ['4/band_4/red']],
+        ['Landsat 8 PQ 25 metre (ls8_pq_scene)', ['pixelquality']]])
+
+    w = widgets.WidgetProducts(test_data)
+    model = w.tree_products.model()
+    w.set_value({'Landsat 8 PQ 25 metre (ls8_pq_scene)': ['pixelquality']})
+
+    w.filter_products.setText('nbart swir')
+    assert model.rowCount() == 3  # Filtering waits for typing to finish
+    w.apply_filter()
+    assert [model.index(row, 0).data() for row in range(model.rowCount())] == [
+        'Landsat 8 NBART 25 metre (ls8_nbart_scene)']
+
+    # Filtering doesn't change the selections
+    assert json.loads(w.value()) == {'Landsat 8 PQ 25 metre (ls8_pq_scene)': ['pixelquality']}
+
+    w.filter_products.clear()
+    w.apply_filter()
+    assert model.rowCount() == 3
+    app.exit(0)
+
+
+def test_products_model():
+
+    app = QgsApplication([], False)
+    from qgis.PyQt.QtCore import Qt
+    from datacube_query.ui import widgets
+
+    test_data = OrderedDict([
+        ['ls8_nbar_albers', ['coastal_aerosol', 'blue', 'green', 'red', 'nir', 'swir1', 'swir2']],
+        ['ls8_pq_albers', []]])
+
+    model = widgets.ProductsModel()
+    model.set_data(test_data)
+    product = model.index(0, 0)
+
+    # Measurement rows are only created when a product is expanded
+    assert model.hasChildren(product)
+    assert model.rowCount(product) == 0
+    assert model.canFetchMore(product)
+    model.fetchMore(product)
+    assert model.rowCount(product) == 7
+    assert not model.canFetchMore(product)
+    assert not model.hasChildren(model.index(1, 0))
+
+    model.setData(product, Qt.Checked, Qt.CheckStateRole)
+    model.setData(model.index(1, 0), Qt.Checked, Qt.CheckStateRole)
+    assert model.get_checked() == test_data
+
+    model.setData(model.index(3, 0, product), Qt.Unchecked, Qt.CheckStateRole)
+    assert model.data(product, Qt.CheckStateRole) == Qt.PartiallyChecked
+    assert model.data(model.index(3, 0, product), Qt.CheckStateRole) == Qt.Unchecked
+    assert model.get_checked()['ls8_nbar_albers'] == ['coastal_aerosol', 'blue', 'green', 'nir', 'swir1', 'swir2']
+
+    # Selections are restored without expanding any other products
+    model.set_checked({'ls8_pq_albers': [], 'ls8_nbar_albers': ['red', 'missing']})
+    assert model.get_checked() == {'ls8_nbar_albers': ['red'], 'ls8_pq_albers': []}
+    app.exit(0)